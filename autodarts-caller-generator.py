@@ -3,16 +3,29 @@ from pathlib import Path
 import platform
 import argparse
 import glob
+import fnmatch
 import shutil
 import csv
 import re
-import codecs
+import io
 import logging
-from google.cloud import texttospeech
-from boto3 import Session
 from contextlib import closing
 import zipfile
 import unicodedata
+from xml.sax.saxutils import escape
+import random
+import sys
+import time
+import struct
+import hashlib
+import json
+import threading
+import subprocess
+import mmap
+import zlib
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 plat = platform.system()
@@ -27,28 +40,120 @@ logger.setLevel(logging.INFO)
 logger.addHandler(sh)
 
 
-VERSION = '1.1.2'
+VERSION = '1.2.0'
 
 DEFAULT_MAX_RETRIES = 3
+MAX_THROTTLE_RETRIES = 10
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_SIZE = 2048
+DEFAULT_VOICE_CATALOG_TTL = 24
+DEFAULT_CONNECTION_POOL_SIZE = 32
+DEFAULT_KEEPALIVE = 30
+DEFAULT_MP3_BITRATE = 64
+DEFAULT_OPUS_BITRATE = 32
+DEFAULT_FFMPEG_PATH = 'ffmpeg'
+DEFAULT_ESPEAK_PATH = 'espeak-ng'
+LOCAL_VOICE_PREFIX = 'espeak-'
+SILENCE_THRESHOLD = -50
+# Upper bounds in seconds of the request-latency histogram
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, 12.8]
+PACKAGING_QUEUE_SIZE = 2
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 10
+PROGRESS_RATE_WINDOW = 30
+ERROR_CLASSES = ['throttled', 'transient', 'fatal']
 
 TEMPLATE_FILE_EXTENSION = '.csv'
 TEMPLATE_FILE_ENCODING = 'utf-8-sig'
-# OUTPUT_FILE_EXTENSION = '.ogg'
-OUTPUT_FILE_EXTENSION = '.mp3'
+OUTPUT_FORMATS = {'mp3': '.mp3', 'opus': '.ogg'}
+OUTPUT_FILE_EXTENSION = OUTPUT_FORMATS['mp3']
 OUTPUT_ARCHIVE_EXTENSION = 'zip'
-SERVICE_PROVIDERS = ['google', 'amazon']
-
-
-
-
-def setup_environment():
-    service = display_menu("Select a provider: ", SERVICE_PROVIDERS)
-    if service == 'amazon':
-        setup_environment_amazon()
-    elif service == 'google':
-        setup_environment_google()
+SHARD_MODES = ['index', 'hash']
+COPY_CHUNK_SIZE = 1024 * 1024
+ZIP_HEADER_INTERNALS = ('structFileHeader', 'sizeFileHeader', '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+ZIP_WRITER_INTERNALS = ('fp', 'filelist', 'NameToInfo', 'start_dir', '_didModify')
+# Batches stay below the smallest ssml-limit of all providers (google: 5000 bytes)
+MAX_SSML_BATCH_BYTES = 4500
+SSML_KEY_OVERHEAD = 80
+SSML_BATCH_PAUSE = 400
+MP3_BITRATES = [
+    [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+]
+MP3_SAMPLE_RATES = [44100, 48000, 32000]
+PACK_MANIFEST_FILE = 'manifest.json'
+OPUS_SAMPLE_RATE = 48000
+JOURNAL_FILE = 'journal.jsonl'
+
+THROTTLING_ERROR_CODES = ['ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded']
+TRANSIENT_ERROR_CODES = ['ServiceFailureException', 'ServiceUnavailableException', 'InternalFailure', 'RequestTimeout', 'RequestTimeoutException']
+
+SYNTHESIS_CACHE = None
+PROVIDERS = {}
+PROVIDER_SLOTS = {}
+CLIENT_FACTORIES = {}
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+RATE_LIMITERS = {}
+REQUESTS_PER_SECOND = {}
+SSML_BATCH_SIZE = 0
+CONNECTION_POOL_SIZE = DEFAULT_CONNECTION_POOL_SIZE
+KEEPALIVE = DEFAULT_KEEPALIVE
+STREAM_PACKAGING = False
+RESUME = False
+SHARD = None
+PRIORITY_PATTERNS = None
+CHECKPOINT_KEYS = 0
+VOICE_CATALOG = None
+VOICE_CATALOG_PATH = None
+VOICE_CATALOG_TTL = DEFAULT_VOICE_CATALOG_TTL
+REFRESH_VOICES = {}
+POST_PROCESSING = None
+POST_PROCESSING_WORKERS = os.cpu_count() or 1
+FFMPEG_PATH = DEFAULT_FFMPEG_PATH
+ESPEAK_PATH = DEFAULT_ESPEAK_PATH
+LOCAL_WORKERS = os.cpu_count() or 1
+RUN_METRICS = None
+TEMPLATE_CATALOG = None
+TEMPLATE_CATALOG_LOCK = threading.Lock()
+PACKAGING_EXECUTOR = None
+PACKAGING_JOBS = {}
+PACKAGING_LOCK = threading.Lock()
+PACKAGING_SLOTS = threading.BoundedSemaphore(PACKAGING_QUEUE_SIZE)
+METRICS_LOCK = threading.Lock()
+DEBUG = False
+
+
+
+
+def register_provider(name, file_prefix, setup, clients, fetch_voice_catalog, generate, concurrency, requests_per_second):
+    # A provider's SDK is only imported by its client-factories, so startup stays fast however many providers are registered
+    PROVIDERS[name] = {
+        'file_prefix': file_prefix,
+        'setup': setup,
+        'fetch_voice_catalog': fetch_voice_catalog,
+        'generate': generate,
+        'concurrency': concurrency,
+        'requests_per_second': requests_per_second,
+    }
+    CLIENT_FACTORIES.update(clients)
+def provider_concurrency(provider):
+    # Default budget of requests in flight; providers bound by this machine resolve it when the run starts
+    concurrency = get_provider(provider)['concurrency']
+    return concurrency() if callable(concurrency) else concurrency
+def get_provider(provider):
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+    return PROVIDERS[provider]
+
+def setup_environment(service = None, interactive = True):
+    if service is None:
+        service = display_menu("Select a provider: ", list(PROVIDERS))
+    get_provider(service)['setup'](interactive)
     return service
-def setup_environment_amazon():
+def setup_environment_amazon(interactive = True):
     user_home = os.environ.get('USERPROFILE') or os.environ.get('HOME')
     credential_path = os.path.join(user_home, '.aws', 'credentials')
     config_path = os.path.join(user_home, '.aws', 'config')
@@ -57,8 +162,14 @@ def setup_environment_amazon():
         raise ValueError(f"The file {credential_path} does not exist or is not readable.")
     if not os.path.isfile(config_path) or not os.access(config_path, os.R_OK):
         raise ValueError(f"The file {config_path} does not exist or is not readable.")
-def setup_environment_google():
+def setup_environment_local(interactive = True):
+    for name, path in (('espeak-ng', ESPEAK_PATH), ('ffmpeg', FFMPEG_PATH)):
+        if shutil.which(path) is None:
+            raise ValueError(f"The local provider needs {name}, but '{path}' was not found.")
+def setup_environment_google(interactive = True):
     if not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
+        if not interactive:
+            raise ValueError("GOOGLE_APPLICATION_CREDENTIALS is not set.")
         path_to_credential_file = None
         while path_to_credential_file is None:
             path = input("Please enter full path to 'text-to-speech-key.json' / credential-file: ")
@@ -127,11 +238,7 @@ def display_menu(text, options):
     return options[selection - 1]
 
 def list_template_files():
-    path = os.path.join(TEMPLATES_PATH, f'*-*-v*{TEMPLATE_FILE_EXTENSION}')
-    # path = "\\\\192.168.0.121\\projects\\autodarts-caller\\*-*-v*.csv"
-    if path.startswith('\\'): 
-        path = f"\{path}"
-    return glob.glob(path)
+    return get_template_catalog().list(TEMPLATES_PATH)
 def choose_template_file():
     template_files = list_template_files()
     return display_menu("Select a template file to use: ", template_files)
@@ -140,6 +247,12 @@ def extract_language_code(template_file_path):
     if match:
         return match.group(1)
     return None
+def get_template_catalog():
+    global TEMPLATE_CATALOG
+    with TEMPLATE_CATALOG_LOCK:
+        if TEMPLATE_CATALOG is None:
+            TEMPLATE_CATALOG = TemplateCatalog()
+        return TEMPLATE_CATALOG
 
 def choose_generation_path():
     while True:
@@ -152,43 +265,112 @@ def choose_generation_path():
         else:
             print("The path does not exist. Please try again.")
 
-def list_voice_names(provider, language_code):
-    if provider == 'amazon':
-        return list_amazon_voice_names(language_code)
-    elif provider == 'google':
-        return list_google_voice_names(language_code)
-def list_amazon_voice_names(language_code):   
-    # Create a client using the credentials and region defined in the [autodarts-caller] section of the AWS credentials file (~/.aws/credentials).
+def get_client(provider):
+    # One long-lived client per provider, shared by voice-listing and every voice-pack of a run,
+    # so connections (TLS / gRPC-channel) are set up once and then kept alive
+    with CLIENTS_LOCK:
+        client = CLIENTS.get(provider)
+        if client is None:
+            client = CLIENT_FACTORIES[provider]()
+            CLIENTS[provider] = client
+        return client
+def create_amazon_client():
+    from boto3 import Session
+    from botocore.config import Config
+
+    # Create a client using the credentials and region defined in the [default] section of the AWS credentials file (~/.aws/credentials).
     # profile_name="autodarts-caller"
     session = Session()
-    client = session.client("polly")
-
-    voices = client.describe_voices(
-            # 'en-GB'
-            LanguageCode=language_code,
-            Engine='neural'
-        )
-    # print(voices)
-    
-    results = []  
-    for voice in voices['Voices']:
-        voice_entry = remove_accents(voice['Name']) + "-" + voice['Gender']
-        results.append(voice_entry)
-    return results
-def list_google_voice_names(language_code):
-    client = texttospeech.TextToSpeechClient()
-
-    # Performs the list voices request
-    voices = client.list_voices(language_code=language_code)
-
-    results = []  
+    # Retries are done by request_with_retries(), so botocore must not hide throttling by retrying on its own
+    config = Config(max_pool_connections=CONNECTION_POOL_SIZE, tcp_keepalive=True, retries={'total_max_attempts': 1})
+    return session.client("polly", config=config)
+def create_google_client():
+    from google.cloud import texttospeech
+    return create_grpc_client(texttospeech)
+def create_google_beta_client():
+    from google.cloud import texttospeech_v1beta1
+    return create_grpc_client(texttospeech_v1beta1)
+def create_grpc_client(api):
+    # All requests are multiplexed over one HTTP/2-channel; keepalive-pings stop it from being dropped between voice-packs
+    transport_class = api.TextToSpeechClient.get_transport_class("grpc")
+    channel = transport_class.create_channel(options=[
+        ("grpc.max_send_message_length", -1),
+        ("grpc.max_receive_message_length", -1),
+        ("grpc.keepalive_time_ms", KEEPALIVE * 1000),
+        ("grpc.keepalive_timeout_ms", 10000),
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.max_pings_without_data", 0),
+    ])
+    return api.TextToSpeechClient(transport=transport_class(channel=channel))
+def create_local_client():
+    return EspeakEngine(ESPEAK_PATH)
+def list_voice_names(provider, language_code):
+    # Voices of all languages are fetched in one call per provider and kept in a local catalog,
+    # so choosing voices works without a request until the catalog expires or is refreshed
+    catalog = load_voice_catalog()
+    entry = catalog.get(provider)
+    expired = entry is None or time.time() - entry['fetched'] > VOICE_CATALOG_TTL * 3600
+    if REFRESH_VOICES.get(provider, False) or expired:
+        try:
+            languages = get_provider(provider)['fetch_voice_catalog']()
+            entry = {'fetched': time.time(), 'languages': languages}
+            catalog[provider] = entry
+            save_voice_catalog(catalog)
+            REFRESH_VOICES[provider] = False
+        except Exception as e:
+            if entry is None:
+                raise
+            print(f"Could not refresh {provider}-voices, using catalog of {time.ctime(entry['fetched'])}: {str(e)}")
+    languages = entry['languages']
+    # Engines with voices per language only (espeak-ng: 'de') offer them for every region of it
+    return languages.get(language_code) or languages.get(language_code.split('-')[0], [])
+def load_voice_catalog():
+    global VOICE_CATALOG
+    if VOICE_CATALOG is None:
+        VOICE_CATALOG = {}
+        if VOICE_CATALOG_PATH is not None and os.path.isfile(VOICE_CATALOG_PATH):
+            try:
+                with open(VOICE_CATALOG_PATH, 'r', encoding='utf-8') as file:
+                    VOICE_CATALOG = json.load(file)
+            except ValueError:
+                print(f"Ignoring unreadable voice-catalog: {VOICE_CATALOG_PATH}")
+    return VOICE_CATALOG
+def save_voice_catalog(catalog):
+    if VOICE_CATALOG_PATH is None:
+        return
+    # A bare file name like 'voices.json' lives in the working directory, which exists already
+    if os.path.dirname(VOICE_CATALOG_PATH):
+        os.makedirs(os.path.dirname(VOICE_CATALOG_PATH), exist_ok=True)
+    temp_path = f"{VOICE_CATALOG_PATH}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(catalog, file, ensure_ascii=False, indent=1)
+    os.replace(temp_path, VOICE_CATALOG_PATH)
+def fetch_amazon_voice_catalog():
+    client = get_client('amazon')
+
+    languages = {}
+    request = {'Engine': 'neural'}
+    while True:
+        voices = client.describe_voices(**request)
+        for voice in voices['Voices']:
+            voice_entry = remove_accents(voice['Name']) + "-" + voice['Gender']
+            languages.setdefault(voice['LanguageCode'], []).append(voice_entry)
+        if not voices.get('NextToken'):
+            break
+        request['NextToken'] = voices['NextToken']
+    return languages
+def fetch_google_voice_catalog():
+    from google.cloud import texttospeech
+    client = get_client('google')
+
+    # Performs the list voices request for all languages
+    voices = client.list_voices()
+
+    languages = {}
     for voice in voices.voices:
 
         voice_entry = remove_accents(voice.name)
 
-        # Display the supported language codes for this voice. Example: "en-US"
-        # for language_code in voice.language_codes:
-        #     voice_entry += "-" + language_code
         # # voice.natural_sample_rate_hertz
 
         ssml_gender = texttospeech.SsmlVoiceGender(voice.ssml_gender)
@@ -196,77 +378,394 @@ def list_google_voice_names(language_code):
         # Display the SSML Voice Gender
         voice_entry += "-" + ssml_gender.name
 
-        results.append(voice_entry)
-    return results
+        # Supported language codes for this voice. Example: "en-US"
+        for language_code in voice.language_codes:
+            languages.setdefault(language_code, []).append(voice_entry)
+    return languages
+def fetch_local_voice_catalog():
+    languages = {}
+    for language, gender in get_client('local').voices():
+        # 'en-us' -> 'en-US', like the language-codes of templates
+        parts = language.split('-')
+        language_code = f"{parts[0]}-{parts[1].upper()}" if len(parts) > 1 and len(parts[1]) == 2 else parts[0]
+        languages.setdefault(language_code, []).append(f"{LOCAL_VOICE_PREFIX}{language}-{gender}")
+    return languages
 def choose_voice_name(provider, voices):
     return display_menu(f"Select a {provider}-voice to use: ", voices)
 
 def read_generation_keys(template_file):
+    return get_template_catalog().keys(template_file)
+def parse_generation_keys(csvfile):
     keys = []
-    with codecs.open(template_file, 'r', encoding=TEMPLATE_FILE_ENCODING) as csvfile:
-        csv_reader = csv.reader(csvfile, delimiter=';')
-        for row in csv_reader:
-            keys.append(row[0])
+    csv_reader = csv.reader(csvfile, delimiter=';')
+    for row in csv_reader:
+        keys.append(row[0])
     return keys
-def restructure_generated_files(generation_path):
-    archive_name = os.path.basename(generation_path)
-    archive_dir = os.path.dirname(generation_path)
-
-    # Liste aller Dateien und Ordner im gegebenen Pfad
-    files_and_folders = os.listdir(generation_path)
-
-    # Temporärer Ordner zum Speichern der Dateien und Ordner vor dem Zippen
-    temp_dir = os.path.join(archive_dir, "temp")
-
-    # Erstelle den temporären Ordner, wenn er nicht existiert
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-
-    # Verschieben Sie alle Dateien und Ordner in den temporären Ordner
-    for item in files_and_folders:
-        shutil.move(os.path.join(generation_path, item), temp_dir)
-
-    # Erstellen Sie das ZIP-Archiv aus dem temporären Ordner
-    shutil.make_archive(os.path.join(archive_dir, archive_name), OUTPUT_ARCHIVE_EXTENSION, temp_dir)
-
-    # Verschieben Sie alle Dateien und Ordner zurück in den ursprünglichen Ordner
-    for item in os.listdir(temp_dir):
-        shutil.move(os.path.join(temp_dir, item), generation_path)
-
-    # Löschen Sie den temporären Ordner
-    shutil.rmtree(temp_dir)
-    # Löscht den Ursprungsordner
-    shutil.rmtree(generation_path)
-
-
-def extract_nested_zip(outer_zip_path, inner_zip_filename, extract_path):
-    # Öffne die äußere Zip-Datei
-    with zipfile.ZipFile(outer_zip_path, 'r') as outer_zip:
-        # Extrahiere die innere Zip-Datei
-        inner_zip_data = outer_zip.read(inner_zip_filename)
-        
-        # Erstelle eine temporäre Datei für die innere Zip-Datei
-        temp_inner_zip_path = os.path.join(extract_path, 'temp_inner.zip')
-        with open(temp_inner_zip_path, 'wb') as temp_inner_zip:
-            temp_inner_zip.write(inner_zip_data)
-        
-        # Öffne die innere Zip-Datei
-        with zipfile.ZipFile(temp_inner_zip_path, 'r') as inner_zip:
-            # Finde den Namen des inneren Ordners
-            inner_folder_name = inner_zip.namelist()[0].split('/')[0]
-            
-            # Extrahiere nur die Dateien aus dem inneren Ordner in das Zielverzeichnis
-            extracted_files_count = 0
-            for inner_file in inner_zip.namelist():
-                if inner_file.startswith(inner_folder_name + '/'):
-                    print("copy previous: " + inner_file)
-                    inner_zip.extract(inner_file, extract_path)
-                    extracted_files_count += 1
-
-        # Lösche die temporäre innere Zip-Datei
-        os.remove(temp_inner_zip_path)
-        return extracted_files_count
-def generate(provider, template_file, language_code, voice_name, raw_mode, only_new_keys = True):
+class TemplateCatalog:
+    # Templates of the run: listed by one directory-scan without a request per file, which is what counts on a slow share.
+    # Parsed keys are kept as long as a template's modification-time and size don't change,
+    # so a template is read once per run however many voices use it.
+    def __init__(self):
+        self.parsed = {}
+        self.lock = threading.Lock()
+
+    def list(self, templates_path):
+        template_files = []
+        with os.scandir(templates_path) as directory:
+            for entry in directory:
+                if not fnmatch.fnmatch(entry.name, f'*-*-v*{TEMPLATE_FILE_EXTENSION}') or not entry.is_file():
+                    continue
+                template_file = os.path.join(str(templates_path), entry.name)
+                # Without a language-code in its name, no voice can be chosen for a template
+                if extract_language_code(template_file) is None:
+                    continue
+                template_files.append(template_file)
+        return sorted(template_files)
+
+    def keys(self, template_file):
+        template_file = str(template_file)
+        stat = os.stat(template_file)
+        with self.lock:
+            parsed = self.parsed.get(template_file)
+            if parsed is not None and parsed[0] == (stat.st_mtime, stat.st_size):
+                return parsed[1]
+
+        with open(template_file, 'r', encoding=TEMPLATE_FILE_ENCODING, newline='') as csvfile:
+            keys = parse_generation_keys(csvfile)
+        with self.lock:
+            self.parsed[template_file] = ((stat.st_mtime, stat.st_size), keys)
+        return keys
+
+def output_file_name(file_prefix, key_index, key, raw_mode):
+    if raw_mode:
+        return f"{key}{OUTPUT_FILE_EXTENSION}"
+    # BL-00001_0_48k_stereo.mp3
+    return f"{file_prefix}-{str(key_index).zfill(5)}_{key_index}_mono{OUTPUT_FILE_EXTENSION}"
+
+def parse_shard(value):
+    # '2/8': the second of eight shards
+    match = re.match(r'^(\d+)/(\d+)$', value.strip())
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"'{value}' is no shard like 2/8")
+    return int(match.group(1)), int(match.group(2))
+def in_shard(key_index, key, key_count):
+    # Index-shards are contiguous ranges of the template. Hash-shards spread the keys evenly whatever their order,
+    # and keys that sound the same always land in the same shard, so they still share one request.
+    shard_index, shard_count = SHARD['index'], SHARD['count']
+    if SHARD['mode'] == 'hash':
+        digest = hashlib.sha256(normalize_key(key).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % shard_count == shard_index - 1
+    return (shard_index - 1) * key_count // shard_count <= key_index < shard_index * key_count // shard_count
+def keys_digest(keys):
+    # Identifies a template by its keys, so partial voice-packs of the same generation can be recognized
+    return hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+
+def read_pack_manifest(outer_zip):
+    if PACK_MANIFEST_FILE not in outer_zip.namelist():
+        return None
+    return json.loads(outer_zip.read(PACK_MANIFEST_FILE).decode('utf-8'))
+def read_pack_checkpoint(pack_path):
+    # Stage of a voice-pack published at a checkpoint; None for a finished voice-pack
+    try:
+        with zipfile.ZipFile(pack_path) as outer_zip:
+            manifest = read_pack_manifest(outer_zip)
+    except (OSError, zipfile.BadZipFile, ValueError):
+        return None
+    return (manifest or {}).get('checkpoint')
+def read_pack_key_map(outer_zip, inner_zip):
+    # Maps every key of a pack to the entry holding its sound. Packs without a manifest
+    # name their files after the template-row, so the embedded template resolves the keys.
+    inner_files = {}
+    for inner_file in inner_zip.namelist():
+        if not inner_file.endswith('/'):
+            inner_files[inner_file.rpartition('/')[2]] = inner_file
+
+    key_map = {}
+    outer_files = outer_zip.namelist()
+    manifest = read_pack_manifest(outer_zip)
+    if manifest is not None:
+        for entry in manifest['keys']:
+            if entry['file'] in inner_files:
+                key_map[entry['key']] = inner_files[entry['file']]
+        return key_map
+
+    template_files = [outer_file for outer_file in outer_files if outer_file.endswith(TEMPLATE_FILE_EXTENSION)]
+    if not template_files:
+        return key_map
+    with io.TextIOWrapper(outer_zip.open(template_files[0]), encoding=TEMPLATE_FILE_ENCODING) as csvfile:
+        keys = parse_generation_keys(csvfile)
+    for file_name, inner_file in inner_files.items():
+        match = re.match(r'^[A-Z]{2}-\d+_(\d+)_mono\.\w+$', file_name)
+        if match and int(match.group(1)) < len(keys):
+            key_map[keys[int(match.group(1))]] = inner_file
+    return key_map
+class PreviousPack:
+    # Read-only view of an existing voice-pack. The inner zip is read through a seekable stream of
+    # the outer zip member, so neither a temporary copy nor the whole inner zip has to be held.
+    def __init__(self, outer_zip_path):
+        self.path = outer_zip_path
+        self.outer_zip = zipfile.ZipFile(outer_zip_path, 'r')
+        inner_zip_filename = os.path.basename(outer_zip_path)
+        self.inner_stream = self.outer_zip.open(inner_zip_filename)
+        self.inner_zip = zipfile.ZipFile(self.inner_stream, 'r')
+        self.key_map = read_pack_key_map(self.outer_zip, self.inner_zip)
+        manifest = read_pack_manifest(self.outer_zip) or {}
+        self.post_processing = manifest.get('post_processing')
+        # Size, checksum and duration carry over with the copied sounds; packs before 1.2.0 don't have them
+        self.file_info = {}
+        for entry in manifest.get('keys', []):
+            if 'sha256' in entry:
+                self.file_info[entry['file']] = AUDIO_INFO.pack(entry['size'], bytes.fromhex(entry['sha256']), round(entry['duration'] * 1000))
+        self.normalized_key_map = {}
+        for key, inner_file in self.key_map.items():
+            self.normalized_key_map.setdefault(normalize_key(key), inner_file)
+
+    def plan(self, keys, file_prefix):
+        # Every unchanged key is reused under the file name of its new position
+        reused = {}
+        for key_index, key in enumerate(keys):
+            inner_file = self.key_map.get(key) or self.normalized_key_map.get(normalize_key(key))
+            if inner_file is not None:
+                reused[key_index] = (output_file_name(file_prefix, key_index, key, False), self.inner_zip.getinfo(inner_file))
+        return reused
+
+    def close(self):
+        self.inner_zip.close()
+        self.inner_stream.close()
+        self.outer_zip.close()
+
+def copy_zip_entry(source_zip, source_info, target_zip, target_name, read_data = False):
+    # Copies the compressed bytes of an entry as they are; CRC and sizes carry over, nothing is recompressed.
+    # With read_data, the copied bytes are decompressed on the way and the content is returned.
+    # The raw copy writes the local header itself and registers the entry in zipfile-internals; checked against CPython 3.8 - 3.13.
+    # Should a later zipfile lack any of them, the entry is read and written again the documented way instead.
+    if not all(hasattr(zipfile, name) for name in ZIP_HEADER_INTERNALS) or not all(hasattr(target_zip, name) for name in ZIP_WRITER_INTERNALS):
+        return rewrite_zip_entry(source_zip, source_info, target_zip, target_name, read_data)
+    source_zip.fp.seek(source_info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source_zip.fp.read(zipfile.sizeFileHeader))
+    source_zip.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    target_info = zipfile.ZipInfo(target_name, source_info.date_time)
+    target_info.compress_type = source_info.compress_type
+    target_info.CRC = source_info.CRC
+    target_info.compress_size = source_info.compress_size
+    target_info.file_size = source_info.file_size
+    target_info.external_attr = source_info.external_attr
+    target_info.header_offset = target_zip.fp.tell()
+    target_zip.fp.write(target_info.FileHeader())
+
+    data = None
+    decompressor = None
+    if read_data:
+        data = bytearray()
+        if source_info.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+    remaining = source_info.compress_size
+    while remaining > 0:
+        chunk = source_zip.fp.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated entry {source_info.filename}")
+        target_zip.fp.write(chunk)
+        remaining -= len(chunk)
+        if data is not None:
+            data += decompressor.decompress(chunk) if decompressor is not None else chunk
+
+    target_zip.filelist.append(target_info)
+    target_zip.NameToInfo[target_name] = target_info
+    target_zip.start_dir = target_zip.fp.tell()
+    target_zip._didModify = True
+    return bytes(data) if data is not None else None
+def rewrite_zip_entry(source_zip, source_info, target_zip, target_name, read_data = False):
+    # Fallback of copy_zip_entry by public zipfile-api only: the entry is decompressed and compressed again chunk by chunk
+    target_info = zipfile.ZipInfo(target_name, source_info.date_time)
+    target_info.compress_type = source_info.compress_type
+    target_info.external_attr = source_info.external_attr
+    data = bytearray() if read_data else None
+    with source_zip.open(source_info) as source, target_zip.open(target_info, 'w', force_zip64=source_info.file_size > zipfile.ZIP64_LIMIT) as target:
+        while True:
+            chunk = source.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            target.write(chunk)
+            if data is not None:
+                data += chunk
+    return bytes(data) if data is not None else None
+def pack_manifest(provider, voice_name, keys, file_prefix, file_info):
+    # The entries are produced while the manifest is written, so they never exist as one list
+    def entries():
+        for key_index, key in enumerate(keys):
+            file_output = output_file_name(file_prefix, key_index, key, False)
+            if file_output in file_info:
+                yield {'index': key_index, 'key': key, 'file': file_output, **audio_info_entry(file_info[file_output])}
+    manifest = {'provider': provider, 'voice': voice_name, 'post_processing': POST_PROCESSING}
+    if SHARD is not None:
+        manifest['shard'] = {**SHARD, 'keys': len(keys), 'template_sha256': keys_digest(keys)}
+    manifest['keys'] = entries()
+    return manifest
+def write_pack_manifest(outer_zip, manifest):
+    # Written entry by entry into the zip, so even the manifest of a huge template isn't held as one document
+    with io.TextIOWrapper(outer_zip.open(PACK_MANIFEST_FILE, 'w', force_zip64=True), encoding='utf-8') as file:
+        header = json.dumps({key: value for key, value in manifest.items() if key != 'keys'}, ensure_ascii=False, indent=1)
+        file.write(header[:-2] + ',\n "keys": [')
+        for entry_index, entry in enumerate(manifest['keys']):
+            file.write(('\n  ' if entry_index == 0 else ',\n  ') + json.dumps(entry, ensure_ascii=False))
+        file.write('\n ]\n}')
+
+
+class GenerationJournal:
+    # Append-only record of the sounds a generation has written so far: one json-line per key with its checksum
+    def __init__(self, path, append):
+        self.path = path
+        self.lock = threading.Lock()
+        torn = False
+        if append and os.path.isfile(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                torn = file.read(1) != b'\n'
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+        if torn:
+            # Fence off a line that was cut by a crash, so the next entry stays readable
+            self.file.write('\n')
+
+    def record(self, key_index, key, file_name, data):
+        entry = {'index': key_index, 'key': key, 'file': file_name, 'sha256': hashlib.sha256(data).hexdigest()}
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_journal(journal_path, generation_path, keys, file_prefix, raw_mode):
+    # Indexes of keys whose sound is still on disk exactly as journaled; everything else has to be requested again
+    completed = set()
+    if not os.path.isfile(journal_path):
+        return completed
+    with open(journal_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            key_index = entry['index']
+            if key_index >= len(keys) or keys[key_index] != entry['key']:
+                continue
+            if entry['file'] != output_file_name(file_prefix, key_index, entry['key'], raw_mode):
+                continue
+            try:
+                with open(os.path.join(generation_path, entry['file']), 'rb') as sound:
+                    data = sound.read()
+            except OSError:
+                continue
+            if data and hashlib.sha256(data).hexdigest() == entry['sha256']:
+                completed.add(key_index)
+    return completed
+
+class DirectoryWriter:
+    # Writes every sound as a file of one directory
+    def __init__(self, path):
+        self.path = path
+        self.files = set()
+        self.journal = None
+        self.metrics = None
+        self.lock = threading.Lock()
+
+    def write(self, file_name, data):
+        with open(os.path.join(self.path, file_name), "wb") as file:
+            file.write(data)
+        with self.lock:
+            self.files.add(file_name)
+
+    def write_duplicate(self, file_name, source_name, data):
+        # Identical sounds share their data on disk where the filesystem allows it
+        file_path = os.path.join(self.path, file_name)
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(os.path.join(self.path, source_name), file_path)
+        except OSError:
+            with open(file_path, "wb") as file:
+                file.write(data)
+        with self.lock:
+            self.files.add(file_name)
+
+class PackWriter:
+    # Writes a voice-pack: the outer zip holds the template copy, the manifest and an inner zip
+    # with one folder of sounds. The pack is written next to its final name and only moved there once it is complete.
+    # Sounds are compressed already, so they and the inner zip are stored as they are instead of deflated again.
+    def __init__(self, pack_path, pack_name, template_file, template_data = None):
+        self.pack_path = pack_path
+        self.path = f"{pack_path}.part"
+        self.folder = pack_name
+        self.file_info = {}
+        self.journal = None
+        self.metrics = None
+        self.lock = threading.Lock()
+
+        self.outer_zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        if template_data is None:
+            self.outer_zip.write(template_file, os.path.basename(template_file))
+        else:
+            self.outer_zip.writestr(os.path.basename(template_file), template_data)
+        inner_zip_info = zipfile.ZipInfo(f"{pack_name}.{OUTPUT_ARCHIVE_EXTENSION}", time.localtime()[:6])
+        inner_zip_info.compress_type = zipfile.ZIP_STORED
+        # The size of the inner zip is only known once it is closed, so it gets zip64-headers from the start;
+        # otherwise a pack past 2 GiB would fail at the very end, after every sound was paid for
+        self.inner_stream = self.outer_zip.open(inner_zip_info, 'w', force_zip64=True)
+        self.inner_zip = zipfile.ZipFile(self.inner_stream, 'w', zipfile.ZIP_STORED)
+        self.inner_zip.writestr(f"{pack_name}/", b'')
+
+    def entry_name(self, file_name):
+        # Every sound is stored once; a second entry of the same name would shadow the first and miss the manifest
+        entry_name = f"{self.folder}/{file_name}"
+        if entry_name in self.inner_zip.NameToInfo:
+            raise ValueError(f"{entry_name} is already in the voice-pack")
+        return entry_name
+
+    def write(self, file_name, data):
+        # Size, checksum and duration for the manifest are taken from the data while it is written
+        file_info = audio_info(file_name, data)
+        with self.lock:
+            self.inner_zip.writestr(self.entry_name(file_name), data)
+            self.file_info[file_name] = file_info
+
+    def write_duplicate(self, file_name, source_name, data):
+        # Identical sounds share size, checksum and duration of their source
+        file_info = self.file_info.get(source_name) or audio_info(file_name, data)
+        with self.lock:
+            self.inner_zip.writestr(self.entry_name(file_name), data)
+            self.file_info[file_name] = file_info
+
+    def write_file(self, file_name, file_path):
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        file_info = audio_info(file_name, data)
+        with self.lock:
+            zip_info = zipfile.ZipInfo.from_file(file_path, self.entry_name(file_name))
+            zip_info.compress_type = self.inner_zip.compression
+            self.inner_zip.writestr(zip_info, data)
+            self.file_info[file_name] = file_info
+
+    def copy_previous(self, previous_pack, reused):
+        # Entries are copied in the order they are stored in the previous pack, so its stream is read front to back
+        for file_name, source_info in sorted(reused.values(), key=lambda entry: entry[1].header_offset):
+            if DEBUG:
+                print(f"copy previous: {source_info.filename} -> {file_name}")
+            file_info = previous_pack.file_info.get(source_info.filename.rpartition('/')[2])
+            with self.lock:
+                data = copy_zip_entry(previous_pack.inner_zip, source_info, self.inner_zip, self.entry_name(file_name), read_data=file_info is None)
+                self.file_info[file_name] = file_info or audio_info(file_name, data)
+
+    def close(self, manifest):
+        self.inner_zip.close()
+        self.inner_stream.close()
+        write_pack_manifest(self.outer_zip, manifest)
+        self.outer_zip.close()
+        os.replace(self.path, self.pack_path)
+
+
+def generate(provider, template_file, language_code, voice_name, raw_mode, only_new_keys = True, background_packaging = False):
     generation_path = GENERATION_PATH
     if raw_mode:
         generation_path = GENERATION_RAW_PATH
@@ -278,8 +777,14 @@ def generate(provider, template_file, language_code, voice_name, raw_mode, only_
     voice_name_path = voice_name
     if not voice_name.lower().startswith(language_code.lower()):
         voice_name_path = language_code + '-' + voice_name
+    if SHARD is not None:
+        # A partial voice-pack, combined with the other shards by --merge
+        voice_name_path = f"{voice_name_path}-part{SHARD['index']}of{SHARD['count']}"
 
     generation_path_main = os.path.join(generation_path, voice_name_path)
+    # The next version can only be numbered and built on once the previous one is packed
+    pack_base = generation_path_main
+    wait_for_packaging(pack_base)
 
     version_counter = 1
     current_version_full_path = f"{generation_path_main}.{OUTPUT_ARCHIVE_EXTENSION}"
@@ -292,25 +797,30 @@ def generate(provider, template_file, language_code, voice_name, raw_mode, only_
                 break
             else:
                 current_version_full_path = version
-            
-    os.makedirs(generation_path_main, exist_ok=True)
-    if os.access(generation_path_main, os.W_OK) == False:
-        raise FileNotFoundError(f"{generation_path_main} is not writeable")
-
-    generation_path = generation_path_main
-    generation_start_index = 0
-    if not raw_mode:
-        # add template-file to generation-path
-        template_file = shutil.copy(template_file, generation_path_main)
 
-        generation_path = os.path.join(generation_path_main, voice_name_path)
+    # A checkpoint is an unfinished version: it is continued under its number and with its journal, instead of starting the next one
+    continue_checkpoint = version_counter > 1 and read_pack_checkpoint(current_version_full_path) is not None
+    if continue_checkpoint:
+        version_counter -= 1
+        generation_path_main = current_version_full_path[:-len(f".{OUTPUT_ARCHIVE_EXTENSION}")]
         if version_counter > 1:
-            generation_path = f"{generation_path}-v{version_counter}"
-        os.makedirs(generation_path, exist_ok=True)
-        if os.access(generation_path, os.W_OK) == False:
-            raise FileNotFoundError(f"{generation_path} is not writeable")
+            current_version_full_path = f"{pack_base}.{OUTPUT_ARCHIVE_EXTENSION}" if version_counter == 2 else f"{pack_base}-v{version_counter - 1}.{OUTPUT_ARCHIVE_EXTENSION}"
+        print(f"Continuing unfinished version: {generation_path_main}.{OUTPUT_ARCHIVE_EXTENSION}")
+
+    pack_name = voice_name_path
+    if version_counter > 1:
+        pack_name = f"{pack_name}-v{version_counter}"
+    stream_packaging = STREAM_PACKAGING and not raw_mode
 
-        # grab existing files of current/previous version and put it in new version`s folder
+    generation_path = generation_path_main
+    keys = read_generation_keys(template_file)
+    file_prefix = get_provider(provider)['file_prefix']
+    previous_pack = None
+    reused = {}
+    if raw_mode:
+        writer = DirectoryWriter(generation_path)
+    else:
+        # grab sounds of unchanged keys of current/previous version for the new version
         use_previous_version = False
         if version_counter > 1:
             if only_new_keys:
@@ -318,111 +828,1043 @@ def generate(provider, template_file, language_code, voice_name, raw_mode, only_
             else:
                 use_previous_version = binary_dialog(f"Do you want to generate only new keys (Default: yes): ", default='yes')
         if use_previous_version:
-            inner_zip = os.path.basename(current_version_full_path)
-            generation_start_index = extract_nested_zip(current_version_full_path, inner_zip, generation_path)
-            print(f"Copied {generation_start_index} files from previous version: {current_version_full_path}")
-            generation_start_index = generation_start_index - 1
-               
-            directory, ext = os.path.splitext(inner_zip)
-            
-            # Define the path of the current directory
-            current_directory = os.path.join(generation_path, directory)
-
-            # Define the path of the parent directory
-            parent_directory = os.path.dirname(current_directory)
-
-            # Iterate through the current directory and move all files to the parent directory
-            for file in os.listdir(current_directory):
-                file_path = os.path.join(current_directory, file)
-                if os.path.isfile(file_path):
-                    print("move previous: " + file)
-                    destination_path = os.path.join(parent_directory, file)
-                    shutil.move(file_path, destination_path)
-            
-            # Remove parent directory
-            os.rmdir(current_directory)
-            # shutil.rmtree(parent_directory)
+            previous_pack = PreviousPack(current_version_full_path)
+            if previous_pack.post_processing == POST_PROCESSING:
+                reused = previous_pack.plan(keys, file_prefix)
+                if SHARD is not None:
+                    reused = {key_index: entry for key_index, entry in reused.items() if in_shard(key_index, keys[key_index], len(keys))}
+                print(f"Reusing {len(reused)} files from previous version: {current_version_full_path}")
+            else:
+                # Mixing differently trimmed, normalized or encoded sounds in one pack would be audible
+                print(f"Previous version was post-processed differently, synthesizing all keys again: {current_version_full_path}")
 
+        if stream_packaging:
+            writer = PackWriter(f"{generation_path_main}.{OUTPUT_ARCHIVE_EXTENSION}", pack_name, template_file)
+        else:
+            generation_path = os.path.join(generation_path_main, pack_name)
+            writer = DirectoryWriter(generation_path)
 
+    completed = set()
+    if not stream_packaging:
+        os.makedirs(generation_path, exist_ok=True)
+        if os.access(generation_path, os.W_OK) == False:
+            raise FileNotFoundError(f"{generation_path} is not writeable")
 
-    keys = read_generation_keys(template_file)
+        # Every written sound is journaled, so an interrupted generation can be resumed without requesting it again
+        journal_path = os.path.join(generation_path_main, JOURNAL_FILE)
+        resume = RESUME or continue_checkpoint
+        if resume:
+            completed = read_journal(journal_path, generation_path, keys, file_prefix, raw_mode)
+            print(f"Resuming: {len(completed)} sounds were already synthesized")
+            for key_index in completed:
+                writer.files.add(output_file_name(file_prefix, key_index, keys[key_index], raw_mode))
+        writer.journal = GenerationJournal(journal_path, append=resume)
+    elif continue_checkpoint:
+        # The checkpoint was generated in directory-layout: its journaled sounds go into the streamed pack,
+        # the directory is removed once the pack is complete
+        checkpoint_path = os.path.join(generation_path_main, pack_name)
+        completed = read_journal(os.path.join(generation_path_main, JOURNAL_FILE), checkpoint_path, keys, file_prefix, raw_mode)
+        print(f"Resuming: {len(completed)} sounds were already synthesized")
+        for key_index in sorted(completed):
+            file_name = output_file_name(file_prefix, key_index, keys[key_index], raw_mode)
+            writer.write_file(file_name, os.path.join(checkpoint_path, file_name))
+
+    # A sound already synthesized for this version wins over the one of the previous version
+    reused = {key_index: entry for key_index, entry in reused.items() if key_index not in completed}
+    if stream_packaging and previous_pack is not None:
+        writer.copy_previous(previous_pack, reused)
+        previous_pack.close()
+
+    # Only added or changed keys need to be synthesized, regardless of their position
+    def skip(key_index, key):
+        return key_index in reused or key_index in completed or (SHARD is not None and not in_shard(key_index, key, len(keys)))
+    items = PendingItems(keys, skip)
+    if SHARD is not None:
+        print(f"Shard {SHARD['index']}/{SHARD['count']} ({SHARD['mode']}): {len(items) + len(reused)} of {len(keys)} keys")
 
     # Remove gender-suffix
     voice_name = voice_name.rpartition("-")[0]
 
-    errors = 0
-    if provider == 'amazon':
-        errors = generate_amazon(keys, generation_path, language_code, voice_name, raw_mode, generation_start_index)
-    elif provider == 'google':
-        errors = generate_google(keys, generation_path, language_code, voice_name, raw_mode, generation_start_index)
-
-    if not raw_mode:
-        # Erstellen Sie die ZIP-Datei
-        # Der Name des zu erstellenden Archivs (ohne .zip Erweiterung)
-        archive_name = os.path.basename(generation_path)
-
-        # Der Pfad, in dem das Archiv erstellt wird
-        archive_dir = os.path.dirname(generation_path)
-
-        # Erstellen Sie die ZIP-Datei
-        shutil.make_archive(os.path.join(archive_dir, archive_name), OUTPUT_ARCHIVE_EXTENSION, archive_dir, archive_name)
-
-        # Löscht den Ursprungsordner
-        shutil.rmtree(generation_path)
-
-        restructure_generated_files(generation_path_main)
+    def build_pack(checkpoint = None):
+        # Builds the voice-pack from the synthesized files and the untouched entries of the previous version
+        pack_writer = PackWriter(f"{generation_path_main}.{OUTPUT_ARCHIVE_EXTENSION}", pack_name, template_file)
+        for file_name in sorted(writer.files):
+            pack_writer.write_file(file_name, os.path.join(generation_path, file_name))
+        if previous_pack is not None:
+            pack_writer.copy_previous(previous_pack, reused)
+        manifest = pack_manifest(provider, voice_name, keys, file_prefix, pack_writer.file_info)
+        if checkpoint is not None:
+            manifest['checkpoint'] = checkpoint
+        pack_writer.close(manifest)
+        return len(pack_writer.file_info)
+
+    # Without priorities or checkpoints, all keys are one stage
+    stages = [items]
+    if PRIORITY_PATTERNS is not None or CHECKPOINT_KEYS > 0:
+        stages = plan_stages(items)
+    publish_checkpoints = len(stages) > 1 and not raw_mode and not stream_packaging
+
+    metrics = get_run_metrics().start_voice(provider, voice_name, template_file, len(items))
+    writer.metrics = metrics
+    try:
+        errors = 0
+        for stage_index, stage in enumerate(stages):
+            errors += get_provider(provider)['generate'](stage, writer, language_code, voice_name, raw_mode)
+            if publish_checkpoints and stage_index < len(stages) - 1:
+                # Every checkpoint replaces the voice-pack atomically, so it can be used while the rest is synthesized.
+                # It is built in full from the sounds on disk each time, which is why checkpoints should be few.
+                sounds = build_pack({'stage': stage_index + 1, 'stages': len(stages)})
+                print(f"Checkpoint {stage_index + 1}/{len(stages)}: {sounds} of {len(keys)} sounds published to {generation_path_main}.{OUTPUT_ARCHIVE_EXTENSION}")
+    finally:
+        get_run_metrics().finish_voice(metrics)
+
+    if writer.journal is not None:
+        writer.journal.close()
+        if raw_mode:
+            os.remove(writer.journal.path)
+
+    if not raw_mode and not stream_packaging:
+        def package():
+            build_pack()
+            if previous_pack is not None:
+                previous_pack.close()
+
+            # Löscht den Ursprungsordner
+            shutil.rmtree(generation_path_main)
+
+        if background_packaging:
+            submit_packaging(pack_base, package)
+        else:
+            package()
+    elif not raw_mode:
+        writer.close(pack_manifest(provider, voice_name, keys, file_prefix, writer.file_info))
+        if continue_checkpoint and os.path.isdir(generation_path_main):
+            shutil.rmtree(generation_path_main)
 
     print(f"Generation finished with {errors} errors")
     return errors
-def generate_amazon(keys, generation_path, language_code, language_name, raw_mode, index):
-    # Create a client using the credentials and region defined in the [default] section of the AWS credentials file (~/.aws/credentials).
-    # profile_name="autodart-caller"
-    session = Session()
-    client = session.client("polly")
 
-    errors = 0
-    print(f"Generating {len(keys[index:])} sounds:")
-    for key_index, key in enumerate(keys[index:], start=index):
-        print(f"{key_index}) {key}")
-
-        tries = 1
-        success = False
-        while not success and tries <= MAX_RETRIES:
+def submit_packaging(pack_base, package):
+    # Packaging runs behind the synthesis of the next voice. The queue is short: once it is full,
+    # the next voice waits before it is handed over, so packaging can't fall far behind.
+    global PACKAGING_EXECUTOR
+    PACKAGING_SLOTS.acquire()
+    with PACKAGING_LOCK:
+        if PACKAGING_EXECUTOR is None:
+            PACKAGING_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+        future = PACKAGING_EXECUTOR.submit(package)
+        PACKAGING_JOBS[pack_base] = future
+    future.add_done_callback(lambda _: PACKAGING_SLOTS.release())
+
+def wait_for_packaging(pack_base = None):
+    # Waits until the voice-pack of one voice (or of all voices) is written; returns the count of voice-packs that failed
+    with PACKAGING_LOCK:
+        jobs = [(job_base, future) for job_base, future in PACKAGING_JOBS.items() if pack_base is None or job_base == pack_base]
+        for job_base, _ in jobs:
+            del PACKAGING_JOBS[job_base]
+    failed = 0
+    for job_base, future in jobs:
+        try:
+            future.result()
+        except Exception as e:
+            failed += 1
+            print(f"Packaging failed for {job_base}: {str(e)}")
+    return failed
+class SynthesisCache:
+    # Content-addressed store of synthesized audio: one file per hash of provider, voice, audio-config and text.
+    # The modification time of an entry is its last use, so eviction drops the least recently used entries first.
+    def __init__(self, path, max_size_mb):
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.size = sum(size for _, _, size in self.entries())
+
+    @staticmethod
+    def hash(context, text):
+        return hashlib.sha256(json.dumps([*context, text], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def entry_path(self, cache_key):
+        return os.path.join(self.path, cache_key[:2], cache_key)
+
+    def entries(self):
+        for entry_dir in os.scandir(self.path):
+            if entry_dir.is_dir():
+                for entry in os.scandir(entry_dir.path):
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, cache_key):
+        entry_path = self.entry_path(cache_key)
+        try:
+            with open(entry_path, 'rb') as file:
+                data = file.read()
+            os.utime(entry_path)
+        except OSError:
+            data = None
+        with self.lock:
+            if data:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return data or None
+
+    def put(self, cache_key, data):
+        entry_path = self.entry_path(cache_key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, entry_path)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Trim down to 90% of the limit so a full cache does not rescan on every put
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+        for entry_path, _, size in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(entry_path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+class RateLimiter:
+    # Token-bucket sized to a provider's requests-per-second quota. Being throttled halves the rate,
+    # every success wins a little of it back, so throughput settles at the quota the provider really grants.
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        # No bursts: requests are spaced evenly, as providers count them in short windows
+        self.capacity = 1.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate * 0.1, self.rate * 0.5)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.02)
+
+def get_rate_limiter(provider):
+    with CLIENTS_LOCK:
+        if provider not in RATE_LIMITERS:
+            rate = REQUESTS_PER_SECOND.get(provider, get_provider(provider)['requests_per_second'])
+            RATE_LIMITERS[provider] = RateLimiter(rate) if rate > 0 else None
+        return RATE_LIMITERS[provider]
+
+def classify_error(e):
+    # 'throttled': over quota, retry later and slow down - 'transient': retry later - 'fatal': retrying won't help
+    # Provider-exceptions are recognized by their attributes, so neither botocore nor google.api_core is needed here
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict) and 'Error' in response:
+        code = response['Error'].get('Code', '')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in THROTTLING_ERROR_CODES or status == 429:
+            return 'throttled'
+        if code in TRANSIENT_ERROR_CODES or status >= 500:
+            return 'transient'
+        return 'fatal'
+
+    if isinstance(e, ValueError):
+        # Responses that can't be used (e.g. audio that can't be split at its marks) won't get better by asking again
+        return 'fatal'
+    name = type(e).__name__
+    if name in ('ResourceExhausted', 'TooManyRequests'):
+        return 'throttled'
+    code = getattr(e, 'code', None)
+    if isinstance(code, int) and 400 <= code < 500 and code not in (408, 429):
+        return 'fatal'
+    if name in ('InvalidArgument', 'NotFound', 'PermissionDenied', 'Unauthenticated', 'FailedPrecondition', 'NoCredentialsError', 'ParamValidationError'):
+        return 'fatal'
+    return 'transient'
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter, so retrying workers don't hit the provider in lockstep
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * (2 ** attempt)))
+
+def request_with_retries(request, label, metrics = None):
+    # Throttling is expected under load and doesn't use up the retries, up to its own limit
+    tries = 1
+    throttled = 0
+    while True:
+        try:
+            return request()
+        except Exception as e:
+            error_class = classify_error(e)
+            print(f"{label}) {error_class}: {str(e)}")
+            if metrics is not None:
+                metrics.request_failed(error_class)
+            if error_class == 'fatal':
+                raise
+            if error_class == 'throttled' and throttled < MAX_THROTTLE_RETRIES:
+                throttled += 1
+                time.sleep(backoff_delay(throttled))
+                continue
             tries += 1
-            try:     
-                response = client.synthesize_speech(
-                    Text=key, 
-                    OutputFormat="mp3", 
-                    VoiceId=language_name,
-                    Engine='neural',
-                    SampleRate='24000'
-                    )
-
-                # Access the audio stream from the response
-                if "AudioStream" in response:
-                        # Note: Closing the stream is important because the service throttles on the
-                        # number of parallel connections. Here we are using contextlib.closing to
-                        # ensure the close method of the stream object will be called automatically
-                        # at the end of the with statement's scope.
-                        with closing(response["AudioStream"]) as stream:
-                            file_output = f"{key}{OUTPUT_FILE_EXTENSION}"
-                            if not raw_mode:
-                                # BL-00001_0_48k_stereo.mp3
-                                file_output = f"AM-{str(key_index).zfill(5)}_{key_index}_mono{OUTPUT_FILE_EXTENSION}"
-
-                            output_file_path = os.path.join(generation_path, file_output)
-
-                            with open(output_file_path, "wb") as file:
-                                file.write(stream.read())   
-                            success = True 
+            if tries > MAX_RETRIES:
+                raise
+            time.sleep(backoff_delay(tries))
+
+class VoiceMetrics:
+    # Counters of one voice-pack; synthesis workers update them concurrently, so updates take the lock of the run
+    def __init__(self, run_metrics, provider, voice, template, keys):
+        self.run_metrics = run_metrics
+        self.lock = run_metrics.lock
+        self.provider = provider
+        self.voice = voice
+        self.template = template
+        self.keys = keys
+        self.done = 0
+        self.failed = 0
+        self.cached = 0
+        self.requests = 0
+        # Latencies are only counted per bucket, so a voice-pack's metrics stay the same size however many keys it has
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_min = None
+        self.latency_max = 0.0
+        self.errors = {error_class: 0 for error_class in ERROR_CLASSES}
+        self.bytes = 0
+        self.characters = 0
+        self.started = time.time()
+        self.finished = None
+
+    def request(self, latency, audio, text, cost):
+        # Batches are billed by the characters of all their keys; amazon bills the speech-marks request as well
+        size = sum(len(part) for part in audio) if isinstance(audio, list) else len(audio or b'')
+        characters = (len(text) if isinstance(text, str) else sum(len(key) for key in text)) * cost
+        with self.lock:
+            self.requests += cost
+            self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+            self.latency_max = max(self.latency_max, latency)
+            self.bytes += size
+            self.characters += characters
+
+    def request_failed(self, error_class):
+        with self.lock:
+            self.errors[error_class] += 1
+
+    def key_done(self, success, cached):
+        with self.lock:
+            if success:
+                self.done += 1
+            else:
+                self.failed += 1
+            if cached:
+                self.cached += 1
+        self.run_metrics.key_done()
+
+    def keys_failed_late(self, count):
+        # Keys that were synthesized, but failed afterwards (post-processing)
+        with self.lock:
+            self.done -= count
+            self.failed += count
+
+    def summary(self):
+        with self.lock:
+            counts = list(self.latency_counts)
+            measured = sum(counts) > 0
+            duration = (self.finished or time.time()) - self.started
+            histogram = {}
+            for bucket_index, count in enumerate(counts):
+                if count > 0:
+                    label = f"<={int(LATENCY_BUCKETS[bucket_index] * 1000)}ms" if bucket_index < len(LATENCY_BUCKETS) else f">{int(LATENCY_BUCKETS[-1] * 1000)}ms"
+                    histogram[label] = count
+            return {
+                'provider': self.provider,
+                'voice': self.voice,
+                'template': os.path.basename(self.template),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'duration': round(duration, 3),
+                'keys': self.keys,
+                'done': self.done,
+                'failed': self.failed,
+                'cached': self.cached,
+                'keys_per_second': round((self.done + self.failed) / duration, 2) if duration > 0 else None,
+                'requests': self.requests,
+                'request_errors': dict(self.errors),
+                'bytes': self.bytes,
+                'characters': self.characters,
+                'latency_p50': round(bucket_percentile(counts, 0.5, self.latency_min, self.latency_max), 4) if measured else None,
+                'latency_p90': round(bucket_percentile(counts, 0.9, self.latency_min, self.latency_max), 4) if measured else None,
+                'latency_p99': round(bucket_percentile(counts, 0.99, self.latency_min, self.latency_max), 4) if measured else None,
+                'latency_max': round(self.latency_max, 4) if measured else None,
+                'latency_histogram': histogram,
+            }
+
+class RunMetrics:
+    # Metrics of all voice-packs generated in one run: a live progress line over the voice-packs in progress,
+    # a summary per voice-pack and a metrics-file (json: the whole run, csv: one row per voice-pack appended).
+    # Finished voice-packs are only kept as their summary, and only if a json-file needs them.
+    def __init__(self, path = None):
+        self.path = path
+        self.active = []
+        self.summaries = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.completions = deque()
+        self.last_progress = 0.0
+        self.interactive = sys.stdout.isatty()
+
+    def start_voice(self, provider, voice, template, keys):
+        voice_metrics = VoiceMetrics(self, provider, voice, template, keys)
+        with self.lock:
+            self.active.append(voice_metrics)
+        return voice_metrics
+
+    def key_done(self):
+        now = time.time()
+        with self.lock:
+            self.completions.append(now)
+            while self.completions[0] < now - PROGRESS_RATE_WINDOW:
+                self.completions.popleft()
+            interval = PROGRESS_INTERVAL if self.interactive else PROGRESS_LOG_INTERVAL
+            if now - self.last_progress < interval:
+                return
+            self.last_progress = now
+        self.print_progress()
+
+    def print_progress(self):
+        # Keys per second over the last seconds, the ETA for all voice-packs in progress
+        with self.lock:
+            active = list(self.active)
+            total = sum(voice_metrics.keys for voice_metrics in active)
+            done = sum(voice_metrics.done + voice_metrics.failed for voice_metrics in active)
+            failed = sum(voice_metrics.failed for voice_metrics in active)
+            characters = sum(voice_metrics.characters for voice_metrics in active)
+            window = max(1.0, time.time() - self.completions[0]) if self.completions else 0
+            rate = len(self.completions) / window if window > 0 else 0
+        eta = time.strftime('%H:%M:%S', time.gmtime((total - done) / rate)) if rate > 0 else '--:--:--'
+        line = f"{done}/{total} keys | {rate:.1f} keys/s | ETA {eta} | {failed} errors | {characters} characters | {len(active)} voice-packs"
+        if self.interactive:
+            print(f"\r{line}   ", end='', flush=True)
+        else:
+            print(line)
+
+    def finish_voice(self, voice_metrics):
+        with self.lock:
+            voice_metrics.finished = time.time()
+            self.active.remove(voice_metrics)
+        if self.interactive:
+            print('')
+        summary = voice_metrics.summary()
+        request_errors = ', '.join(f"{error_class} {count}" for error_class, count in summary['request_errors'].items() if count > 0) or 'none'
+        latency = f"p50 {summary['latency_p50'] * 1000:.0f} ms, p99 {summary['latency_p99'] * 1000:.0f} ms" if summary['latency_p50'] is not None else '-'
+        print(f"Metrics: {summary['keys_per_second']} keys/s | latency {latency} | {summary['requests']} requests | request-errors: {request_errors} | "
+              f"{summary['bytes'] / 1024 / 1024:.1f} MB | {summary['characters']} characters billed")
+        if self.path is not None:
+            self.save(summary)
+
+    def save(self, summary):
+        with METRICS_LOCK:
+            if str(self.path).lower().endswith('.csv'):
+                row = {key: value for key, value in summary.items() if key not in ('request_errors', 'latency_histogram')}
+                row.update({f"request_errors_{error_class}": count for error_class, count in summary['request_errors'].items()})
+                new_file = not os.path.isfile(self.path)
+                with open(self.path, 'a', newline='', encoding='utf-8') as file:
+                    csv_writer = csv.DictWriter(file, fieldnames=list(row))
+                    if new_file:
+                        csv_writer.writeheader()
+                    csv_writer.writerow(row)
+                return
+
+            self.summaries.append(summary)
+            voices = self.summaries
+            totals = {}
+            for key in ('keys', 'done', 'failed', 'cached', 'requests', 'bytes', 'characters'):
+                totals[key] = sum(voice[key] for voice in voices)
+            report = {
+                'version': VERSION,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'duration': round(time.time() - self.started, 3),
+                'totals': totals,
+                'voices': voices,
+            }
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(report, file, ensure_ascii=False, indent=1)
+            os.replace(temp_path, self.path)
+
+def get_run_metrics():
+    global RUN_METRICS
+    with METRICS_LOCK:
+        if RUN_METRICS is None:
+            RUN_METRICS = RunMetrics()
+        return RUN_METRICS
+
+def bucket_percentile(counts, share, minimum, maximum):
+    # Estimates a percentile from counts per LATENCY_BUCKETS-bucket, linear within the bucket it falls into;
+    # the smallest and largest latency narrow the first and the last bucket
+    rank = share * sum(counts)
+    seen = 0
+    for bucket_index, count in enumerate(counts):
+        if count > 0 and seen + count >= rank:
+            lower = max(minimum, LATENCY_BUCKETS[bucket_index - 1] if bucket_index > 0 else 0.0)
+            upper = min(maximum, LATENCY_BUCKETS[bucket_index] if bucket_index < len(LATENCY_BUCKETS) else maximum)
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return maximum
+
+def batch_items(items):
+    # Groups consecutive keys into batches that stay below the SSML-size every provider accepts
+    batch = []
+    batch_size = 0
+    for key_index, key in items:
+        key_size = len(escape(key).encode('utf-8')) + SSML_KEY_OVERHEAD
+        if batch and (len(batch) >= SSML_BATCH_SIZE or batch_size + key_size > MAX_SSML_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append((key_index, key))
+        batch_size += key_size
+    if batch:
+        yield batch
+
+def build_batch_ssml(keys):
+    # Every key is a sentence of its own; its mark sits in the middle of the pause before it,
+    # so cutting the audio at the marks leaves some silence on both sides of every key
+    parts = ['<speak>']
+    for key_index, key in enumerate(keys):
+        if key_index > 0:
+            parts.append(f'<break time="{SSML_BATCH_PAUSE // 2}ms"/>')
+        parts.append(f'<mark name="k{key_index}"/>')
+        if key_index > 0:
+            parts.append(f'<break time="{SSML_BATCH_PAUSE // 2}ms"/>')
+        parts.append(f'<s>{escape(key)}</s>')
+    parts.append('</speak>')
+    return ''.join(parts)
+
+def iter_mp3_frames(data):
+    # Yields (offset, length, duration) of every mpeg-audio layer-3 frame; tags and garbage between frames are skipped
+    offset = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        offset = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f))
+    while offset + 4 <= len(data):
+        header = struct.unpack('>I', data[offset:offset + 4])[0]
+        version = (header >> 19) & 0x3
+        layer = (header >> 17) & 0x3
+        bitrate_index = (header >> 12) & 0xf
+        sample_rate_index = (header >> 10) & 0x3
+        if (header >> 21) != 0x7ff or version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            offset += 1
+            continue
+        mpeg1 = version == 3
+        bitrate = MP3_BITRATES[0 if mpeg1 else 1][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[sample_rate_index] >> (0 if mpeg1 else (1 if version == 2 else 2))
+        samples = 1152 if mpeg1 else 576
+        length = samples // 8 * bitrate // sample_rate + ((header >> 9) & 0x1)
+        yield offset, length, samples / sample_rate
+        offset += length
+
+def split_mp3(data, cut_times):
+    # Cuts mp3-audio into len(cut_times) + 1 parts of whole frames; a frame belongs to the part its middle falls into
+    parts = [bytearray() for _ in range(len(cut_times) + 1)]
+    part_index = 0
+    position = 0.0
+    for frame_index, (offset, length, duration) in enumerate(iter_mp3_frames(data)):
+        frame = data[offset:offset + length]
+        if frame_index == 0 and (b'Xing' in frame[:64] or b'Info' in frame[:64]):
+            # The vbr-header describes the whole stream and would be wrong for every part
+            continue
+        while part_index < len(cut_times) and position + duration / 2 >= cut_times[part_index]:
+            part_index += 1
+        parts[part_index] += frame
+        position += duration
+    if not all(parts):
+        raise ValueError("Audio could not be split into all keys of the batch")
+    return [bytes(part) for part in parts]
+
+def split_batch_audio(audio, mark_times, count):
+    cut_times = []
+    for key_index in range(1, count):
+        if f"k{key_index}" not in mark_times:
+            raise ValueError(f"Mark k{key_index} is missing in the response")
+        cut_times.append(mark_times[f"k{key_index}"])
+    if cut_times != sorted(cut_times):
+        raise ValueError("Marks of the response are out of order")
+    return split_mp3(audio, cut_times)
+
+def scan_mp3(data):
+    # Checks mp3-audio by its frame-headers only, without decoding: (duration in seconds, problem or None)
+    duration = 0.0
+    frames = 0
+    end = 0
+    for frame_index, (offset, length, frame_duration) in enumerate(iter_mp3_frames(data)):
+        end = offset + length
+        if frame_index == 0 and (b'Xing' in data[offset:offset + 64] or b'Info' in data[offset:offset + 64]):
+            continue
+        frames += 1
+        duration += frame_duration
+    if frames == 0:
+        return 0.0, "no mp3-frames"
+    if end > len(data):
+        return duration, f"truncated in the frame at {duration:.3f}s"
+    return duration, None
+
+def scan_ogg(data):
+    # Checks ogg/opus-audio by its page-headers: the granule-position of the last page is its length in 48 kHz-samples,
+    # minus the pre-skip of the opus-header
+    offset = 0
+    pages = 0
+    granule = 0
+    pre_skip = 0
+    end_of_stream = False
+    while offset < len(data):
+        if data[offset:offset + 4] != b'OggS' or offset + 27 > len(data):
+            return 0.0, f"no ogg-page at byte {offset}"
+        segments = data[offset + 26]
+        body = offset + 27 + segments
+        page_end = body + sum(data[offset + 27:body])
+        if body > len(data) or page_end > len(data):
+            return 0.0, f"truncated in page {pages}"
+        if pages == 0 and data[body:body + 8] == b'OpusHead':
+            pre_skip = struct.unpack('<H', data[body + 10:body + 12])[0]
+        page_granule = struct.unpack('<q', data[offset + 6:offset + 14])[0]
+        if page_granule >= 0:
+            granule = page_granule
+        end_of_stream = bool(data[offset + 5] & 0x4)
+        pages += 1
+        offset = page_end
+    if pages == 0:
+        return 0.0, "no ogg-pages"
+    duration = max(0, granule - pre_skip) / OPUS_SAMPLE_RATE
+    if not end_of_stream:
+        return duration, "truncated, the end-of-stream page is missing"
+    return duration, None
+
+def scan_audio(file_name, data):
+    if file_name.endswith(OUTPUT_FORMATS['opus']):
+        return scan_ogg(data)
+    return scan_mp3(data)
+
+# Kept for every sound of a pack until its manifest is written, so it is packed into 40 bytes:
+# size, raw sha256-digest and duration in milliseconds
+AUDIO_INFO = struct.Struct('<I32sI')
+
+def audio_info(file_name, data):
+    duration, _ = scan_audio(file_name, data)
+    return AUDIO_INFO.pack(len(data), hashlib.sha256(data).digest(), round(duration * 1000))
+
+def audio_info_entry(info):
+    size, digest, duration = AUDIO_INFO.unpack(info)
+    return {'size': size, 'sha256': digest.hex(), 'duration': duration / 1000}
+
+class IncompleteAudioError(Exception):
+    # A response that ended early or carried no audio; asking again usually helps
+    pass
+
+def check_audio(audio):
+    if not audio:
+        raise IncompleteAudioError("Response contains no audio")
+    _, problem = scan_mp3(audio)
+    if problem is not None:
+        raise IncompleteAudioError(f"Response contains broken audio: {problem}")
+    return audio
+
+def limit_requests(provider, synthesize, cost = 1, metrics = None):
+    # Requests are spaced by the provider's rate-limiter; in batch-mode all voice-packs
+    # of a provider also share one budget of in-flight requests
+    slots = PROVIDER_SLOTS.get(provider)
+    rate_limiter = get_rate_limiter(provider)
+    def synthesize_limited(key):
+        if rate_limiter is not None:
+            for _ in range(cost):
+                rate_limiter.acquire()
+        try:
+            # Latency is measured without the wait for the rate-limiter
+            started = time.perf_counter()
+            if slots is None:
+                audio = synthesize(key)
+            else:
+                with slots:
+                    audio = synthesize(key)
+            if metrics is not None:
+                metrics.request(time.perf_counter() - started, audio, key, cost)
+        except Exception as e:
+            if rate_limiter is not None and classify_error(e) == 'throttled':
+                rate_limiter.throttled()
+            raise
+        if rate_limiter is not None:
+            rate_limiter.succeeded()
+        return audio
+    return synthesize_limited
+def normalize_key(key):
+    # Keys that only differ in case or whitespace sound the same
+    return ' '.join(key.split()).casefold()
+
+def plan_synthesis(items):
+    # One request per distinct utterance: the first key of a group is synthesized, the others reuse its sound.
+    # Only groups with more than one key are kept; the unique items are taken from a second pass over items.
+    duplicates = {}
+    duplicate_indexes = set()
+    first_index = {}
+    for key_index, key in items:
+        normalized = normalize_key(key)
+        if normalized in first_index:
+            duplicates.setdefault(first_index[normalized], []).append((key_index, key))
+            duplicate_indexes.add(key_index)
+        else:
+            first_index[normalized] = key_index
+    unique_items = (item for item in items if item[0] not in duplicate_indexes)
+    return unique_items, len(items) - len(duplicate_indexes), duplicates
+
+class PendingItems:
+    # The (index, key)-items of a template that still need a sound. They are produced anew on every pass
+    # instead of being held as a list, so a large template is only kept once, as its keys.
+    def __init__(self, keys, skip):
+        self.keys = keys
+        self.skip = skip
+        self.count = sum(1 for _ in self)
+
+    def __iter__(self):
+        for key_index, key in enumerate(self.keys):
+            if not self.skip(key_index, key):
+                yield key_index, key
+
+    def __len__(self):
+        return self.count
+
+def read_priority_patterns(path):
+    # One key or wildcard-pattern per line, most important first; empty lines and '#'-comments are skipped
+    with open(path, 'r', encoding='utf-8-sig') as file:
+        return [normalize_key(line) for line in file if line.strip() and not line.lstrip().startswith('#')]
+def plan_stages(items):
+    # Cuts items into stages that are synthesized one after another, each followed by a checkpoint voice-pack:
+    # first the keys matching a priority-pattern (in the order of the patterns), then the rest every CHECKPOINT_KEYS keys.
+    # A key that sounds like a key of an earlier stage joins that stage, so it still costs no request.
+    exact = {}
+    wildcards = []
+    for rank, pattern in enumerate(PRIORITY_PATTERNS or []):
+        if any(char in pattern for char in '*?['):
+            wildcards.append((rank, re.compile(fnmatch.translate(pattern))))
+        else:
+            exact.setdefault(pattern, rank)
+
+    prioritized = []
+    rest = []
+    for key_index, key in items:
+        normalized = normalize_key(key)
+        rank = exact.get(normalized)
+        for wildcard_rank, wildcard in wildcards:
+            if rank is not None and wildcard_rank > rank:
+                break
+            if wildcard.match(normalized):
+                rank = wildcard_rank
+                break
+        if rank is None:
+            rest.append((key_index, key))
+        else:
+            prioritized.append((rank, key_index, key))
+
+    stages = [[(key_index, key) for _, key_index, key in sorted(prioritized)]]
+    stage_size = CHECKPOINT_KEYS if CHECKPOINT_KEYS > 0 else max(1, len(rest))
+    stages += [rest[start:start + stage_size] for start in range(0, len(rest), stage_size)]
+
+    planned = [[] for _ in stages]
+    first_stage = {}
+    for stage_index, stage in enumerate(stages):
+        for key_index, key in stage:
+            planned[first_stage.setdefault(normalize_key(key), stage_index)].append((key_index, key))
+    return [stage for stage in planned if stage]
+
+class KeySynthesizer:
+    # Synthesizes (index, key)-items of one voice with a bounded pool of workers; requests may finish out of order,
+    # but every key still ends up in the file named after its own index.
+    def __init__(self, writer, raw_mode, file_prefix, synthesize, cache_context, synthesize_batch = None, workers = None):
+        self.writer = writer
+        self.workers = workers or WORKERS
+        self.raw_mode = raw_mode
+        self.file_prefix = file_prefix
+        self.synthesize = synthesize
+        self.synthesize_batch = synthesize_batch
+        self.cache_context = cache_context
+        # Sounds cut out of a batch have padding and the prosody of their neighbours, so they are cached apart from
+        # single requests; a batch may use a cached single sound, a single request never gets a cut one
+        self.batch_cache_context = (*cache_context, 'ssml-batch')
+        self.duplicates = {}
+        self.metrics = writer.metrics
+        self.post_processor = None
+        self.post_processing_slots = None
+        self.post_processing_errors = 0
+        self.lock = threading.Lock()
+
+    def run(self, items):
+        unique_items, unique_count, self.duplicates = plan_synthesis(items)
+        print(f"Generating {len(items)} sounds with {self.workers} workers:")
+        if unique_count < len(items):
+            print(f"Plan: {unique_count} distinct utterances, {len(items) - unique_count} requests saved by reusing identical keys")
+
+        if self.synthesize_batch is not None and SSML_BATCH_SIZE > 1:
+            tasks = batch_items(unique_items)
+        else:
+            tasks = ([item] for item in unique_items)
+
+        errors = 0
+        cache_hits = 0
+        max_pending = self.workers * 2
+        if POST_PROCESSING is not None:
+            # Every post-processing job is an ffmpeg-process; one per core, with a short queue so finished downloads don't pile up in memory
+            self.post_processor = ThreadPoolExecutor(max_workers=POST_PROCESSING_WORKERS)
+            self.post_processing_slots = threading.BoundedSemaphore(POST_PROCESSING_WORKERS * 4)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            while True:
+                for task in tasks:
+                    pending.add(executor.submit(self.synthesize_task, task))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for key_index, key, success, cached in future.result():
+                        for duplicate_index, duplicate_key in [(key_index, key)] + self.duplicates.get(key_index, []):
+                            if DEBUG:
+                                print(f"{duplicate_index}) {duplicate_key}{' (cached)' if cached else ''}")
+                            if self.metrics is not None:
+                                self.metrics.key_done(success, cached)
+                            if not success:
+                                errors += 1
+                            if cached:
+                                cache_hits += 1
+
+        if self.post_processor is not None:
+            self.post_processor.shutdown(wait=True)
+            errors += self.post_processing_errors
+
+        if SYNTHESIS_CACHE is not None:
+            print(f"Cache: {cache_hits} of {len(items)} sounds reused without a provider request")
+        return errors
+
+    def synthesize_task(self, task):
+        if len(task) > 1:
+            return self.synthesize_batch_keys(task)
+        key_index, key = task[0]
+        return [(key_index, key, *self.synthesize_key(key_index, key))]
+
+    def write_sound(self, key_index, key, audio):
+        if self.post_processor is None:
+            self.store_sound(key_index, key, audio)
+            return
+        # Synthesis workers hand the sound over and go on requesting while ffmpeg works on it
+        self.post_processing_slots.acquire()
+        future = self.post_processor.submit(self.post_process_sound, key_index, key, audio)
+        future.add_done_callback(lambda _: self.post_processing_slots.release())
+
+    def post_process_sound(self, key_index, key, audio):
+        try:
+            self.store_sound(key_index, key, post_process_audio(audio))
+        except Exception as e:
+            print(f"{key_index}) post-processing failed: {str(e)}")
+            failed = 1 + len(self.duplicates.get(key_index, []))
+            with self.lock:
+                self.post_processing_errors += failed
+            if self.metrics is not None:
+                self.metrics.keys_failed_late(failed)
+
+    def store_sound(self, key_index, key, audio):
+        file_output = output_file_name(self.file_prefix, key_index, key, self.raw_mode)
+        self.writer.write(file_output, audio)
+        if self.writer.journal is not None:
+            self.writer.journal.record(key_index, key, file_output, audio)
+
+        for duplicate_index, duplicate_key in self.duplicates.get(key_index, []):
+            duplicate_output = output_file_name(self.file_prefix, duplicate_index, duplicate_key, self.raw_mode)
+            if duplicate_output == file_output:
+                continue
+            self.writer.write_duplicate(duplicate_output, file_output, audio)
+            if self.writer.journal is not None:
+                self.writer.journal.record(duplicate_index, duplicate_key, duplicate_output, audio)
+
+    def synthesize_key(self, key_index, key):
+        audio = None
+        cache_key = None
+        if SYNTHESIS_CACHE is not None:
+            cache_key = SYNTHESIS_CACHE.hash(self.cache_context, key)
+            audio = SYNTHESIS_CACHE.get(cache_key)
+        cached = audio is not None
+
+        try:
+            if audio is None:
+                audio = request_with_retries(lambda: check_audio(self.synthesize(key)), key_index, self.metrics)
+                if cache_key is not None:
+                    SYNTHESIS_CACHE.put(cache_key, audio)
+            self.write_sound(key_index, key, audio)
+            return True, cached
+        except Exception as e:
+            print(f"{key_index}) failed: {str(e)}")
+            return False, cached
+
+    def synthesize_batch_keys(self, batch):
+        # Synthesizes several keys with one request; if the batch fails or can't be split, every key is requested on its own
+        results = []
+        missing = []
+        for key_index, key in batch:
+            audio = None
+            if SYNTHESIS_CACHE is not None:
+                audio = SYNTHESIS_CACHE.get(SYNTHESIS_CACHE.hash(self.cache_context, key)) or SYNTHESIS_CACHE.get(SYNTHESIS_CACHE.hash(self.batch_cache_context, key))
+            if audio is None:
+                missing.append((key_index, key))
+                continue
+            try:
+                self.write_sound(key_index, key, audio)
+                results.append((key_index, key, True, True))
             except Exception as e:
-                print(str(e))
-                if tries > MAX_RETRIES:
-                    errors += 1            
-    return errors   
-def generate_google(keys, generation_path, language_code, language_name, raw_mode, index):
-    # Instantiates a client
-    client = texttospeech.TextToSpeechClient()
+                print(f"{key_index}) failed: {str(e)}")
+                results.append((key_index, key, False, True))
+        if not missing:
+            return results
+
+        label = f"{missing[0][0]}-{missing[-1][0]}"
+        try:
+            audios = request_with_retries(lambda: [check_audio(audio) for audio in self.synthesize_batch([key for _, key in missing])], label, self.metrics)
+        except Exception as e:
+            print(f"{label}) batch failed, requesting keys one by one: {str(e)}")
+            audios = None
+
+        for item_index, (key_index, key) in enumerate(missing):
+            if audios is None:
+                results.append((key_index, key, *self.synthesize_key(key_index, key)))
+                continue
+            try:
+                if SYNTHESIS_CACHE is not None:
+                    SYNTHESIS_CACHE.put(SYNTHESIS_CACHE.hash(self.batch_cache_context, key), audios[item_index])
+                self.write_sound(key_index, key, audios[item_index])
+                results.append((key_index, key, True, False))
+            except Exception as e:
+                print(f"{key_index}) failed: {str(e)}")
+                results.append((key_index, key, False, False))
+        return results
+
+def mp3_sample_rate(data):
+    for offset, _, _ in iter_mp3_frames(data):
+        header = struct.unpack('>I', data[offset:offset + 4])[0]
+        version = (header >> 19) & 0x3
+        return MP3_SAMPLE_RATES[(header >> 10) & 0x3] >> (0 if version == 3 else (1 if version == 2 else 2))
+    return None
+
+def post_process_audio(audio):
+    # Trims silence at both ends, normalizes loudness and encodes the sound by one ffmpeg-process reading and writing pipes
+    filters = []
+    if POST_PROCESSING['trim_silence']:
+        trim = f"silenceremove=start_periods=1:start_threshold={SILENCE_THRESHOLD}dB"
+        filters += [trim, 'areverse', trim, 'areverse']
+    if POST_PROCESSING['loudness'] is not None:
+        filters.append(f"loudnorm=I={POST_PROCESSING['loudness']}:TP=-1.5:LRA=11")
+
+    command = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-f', 'mp3', '-i', 'pipe:0', '-map_metadata', '-1', '-ac', '1']
+    if filters:
+        command += ['-af', ','.join(filters)]
+    if POST_PROCESSING['format'] == 'opus':
+        command += ['-c:a', 'libopus', '-b:a', f"{POST_PROCESSING['bitrate']}k", '-ar', '48000', '-f', 'ogg']
+    else:
+        # loudnorm works at 192 kHz, so the sample-rate of the provider is restored
+        sample_rate = mp3_sample_rate(audio)
+        if sample_rate is not None:
+            command += ['-ar', str(sample_rate)]
+        command += ['-c:a', 'libmp3lame', '-b:a', f"{POST_PROCESSING['bitrate']}k", '-id3v2_version', '0', '-f', 'mp3']
+    command.append('pipe:1')
+
+    processed = run_pipe(command, audio)
+    _, problem = scan_audio(OUTPUT_FILE_EXTENSION, processed)
+    if problem is not None:
+        raise ValueError(f"ffmpeg returned broken audio: {problem}")
+    return processed
+def run_pipe(command, data):
+    # Runs an executable that reads from stdin and writes its result to stdout
+    result = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not result.stdout:
+        message = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise ValueError(f"{os.path.basename(command[0])} failed: {message[-1] if message else f'exit-code {result.returncode}'}")
+    return result.stdout
+
+def synthesize_keys(items, writer, raw_mode, file_prefix, synthesize, cache_context, synthesize_batch = None, workers = None):
+    return KeySynthesizer(writer, raw_mode, file_prefix, synthesize, cache_context, synthesize_batch, workers).run(items)
+
+def generate_amazon(items, writer, language_code, language_name, raw_mode):
+    client = get_client('amazon')
+
+    def synthesize(key):
+        response = client.synthesize_speech(
+            Text=key, 
+            OutputFormat="mp3", 
+            VoiceId=language_name,
+            Engine='neural',
+            SampleRate='24000'
+            )
+
+        # Access the audio stream from the response
+        if "AudioStream" not in response:
+            raise ValueError("Response contains no AudioStream")
+
+        # Note: Closing the stream is important because the service throttles on the
+        # number of parallel connections. Here we are using contextlib.closing to
+        # ensure the close method of the stream object will be called automatically
+        # at the end of the with statement's scope.
+        with closing(response["AudioStream"]) as stream:
+            return stream.read()
+
+    def synthesize_batch(keys):
+        # Speech marks are a second request on the same ssml: they tell where every key starts in the audio
+        ssml = build_batch_ssml(keys)
+        response = client.synthesize_speech(
+            Text=ssml,
+            TextType='ssml',
+            OutputFormat="json",
+            SpeechMarkTypes=['ssml'],
+            VoiceId=language_name,
+            Engine='neural'
+            )
+        with closing(response["AudioStream"]) as stream:
+            marks = [json.loads(line) for line in stream.read().decode('utf-8').splitlines() if line.strip()]
+        mark_times = {mark['value']: mark['time'] / 1000 for mark in marks if mark['type'] == 'ssml'}
+
+        response = client.synthesize_speech(
+            Text=ssml,
+            TextType='ssml',
+            OutputFormat="mp3",
+            VoiceId=language_name,
+            Engine='neural',
+            SampleRate='24000'
+            )
+        with closing(response["AudioStream"]) as stream:
+            return split_batch_audio(stream.read(), mark_times, len(keys))
+
+    # Everything that changes the returned audio has to be part of the cache key
+    cache_context = ('amazon', language_name, 'neural', 'mp3', '24000')
+    return synthesize_keys(items, writer, raw_mode, get_provider('amazon')['file_prefix'], limit_requests('amazon', synthesize, metrics=writer.metrics), cache_context,
+                           limit_requests('amazon', synthesize_batch, cost=2, metrics=writer.metrics))
+def generate_google(items, writer, language_code, language_name, raw_mode):
+    from google.cloud import texttospeech
+    from google.cloud import texttospeech_v1beta1
+    client = get_client('google')
 
     # Build the voice request, select the language code ("en-US") and the ssml voice gender ("neutral")
     # ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL, 
@@ -452,44 +1894,366 @@ def generate_google(keys, generation_path, language_code, language_name, raw_mod
     #     # effects_profile_id=["large-home-entertainment-class-device"],
     # )
 
-    errors = 0
-    print(f"Generating {len(keys[index:])} sounds:")
-    for key_index, key in enumerate(keys[index:], start=index):
-        print(f"{key_index}) {key}")
+    def synthesize(key):
+        # Set the text input to be synthesized
+        synthesis_input = texttospeech.SynthesisInput(text=key)
 
-        tries = 1
-        success = False
-        while not success and tries <= MAX_RETRIES:
-            tries += 1
+        # Perform the text-to-speech request on the text input with the selected
+        # voice parameters and audio file type
+        response = client.synthesize_speech(
+            input=synthesis_input, 
+            voice=voice, 
+            audio_config=audio_config
+        )
+
+        # The response's audio_content is binary.
+        return response.audio_content
+
+    def synthesize_batch(keys):
+        # Timepoints of ssml-marks are only offered by the v1beta1-api
+        beta_client = get_client('google-v1beta1')
+        request = texttospeech_v1beta1.SynthesizeSpeechRequest(
+            input=texttospeech_v1beta1.SynthesisInput(ssml=build_batch_ssml(keys)),
+            voice=texttospeech_v1beta1.VoiceSelectionParams(language_code=language_code, name=language_name),
+            audio_config=texttospeech_v1beta1.AudioConfig(
+                audio_encoding=texttospeech_v1beta1.AudioEncoding.MP3,
+                sample_rate_hertz=44100,
+                effects_profile_id=["large-home-entertainment-class-device"],
+            ),
+            enable_time_pointing=[texttospeech_v1beta1.SynthesizeSpeechRequest.TimepointType.SSML_MARK],
+        )
+        response = beta_client.synthesize_speech(request=request)
+        mark_times = {timepoint.mark_name: timepoint.time_seconds for timepoint in response.timepoints}
+        return split_batch_audio(response.audio_content, mark_times, len(keys))
+
+    # Everything that changes the returned audio has to be part of the cache key
+    cache_context = ('google', language_code, language_name, 'mp3', 44100, 'large-home-entertainment-class-device')
+    return synthesize_keys(items, writer, raw_mode, get_provider('google')['file_prefix'], limit_requests('google', synthesize, metrics=writer.metrics), cache_context,
+                           limit_requests('google', synthesize_batch, metrics=writer.metrics))
+class EspeakEngine:
+    # Offline text-to-speech by espeak-ng: no account, no requests, no costs. Every sound is synthesized by a pair of processes
+    # (espeak-ng -> wav -> ffmpeg -> mp3), so the workers of a voice-pack keep all cores busy while they only wait on pipes.
+    def __init__(self, path):
+        self.path = path
+        # The version is part of the cache key: another espeak-ng sounds different
+        self.version = run_pipe([path, '--version'], None).decode('utf-8', 'replace').strip()
+
+    def voices(self):
+        # Pty Language       Age/Gender VoiceName          File                 Other Languages
+        #  5  de              --/M      German             gmw/de
+        voices = []
+        for line in run_pipe([self.path, '--voices'], None).decode('utf-8', 'replace').splitlines()[1:]:
+            fields = line.split()
+            if len(fields) >= 4:
+                gender = {'M': 'Male', 'F': 'Female'}.get(fields[2].rpartition('/')[2], 'Neutral')
+                voices.append((fields[1], gender))
+        return voices
+
+    def synthesize(self, voice, text):
+        # Text goes through stdin, so keys starting with '-' aren't taken for options
+        wav = run_pipe([self.path, '-v', voice, '-b', '1', '--stdin', '--stdout'], text.encode('utf-8'))
+        return run_pipe([FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-f', 'wav', '-i', 'pipe:0', '-map_metadata', '-1', '-ac', '1',
+                         '-c:a', 'libmp3lame', '-b:a', f"{DEFAULT_MP3_BITRATE}k", '-id3v2_version', '0', '-f', 'mp3', 'pipe:1'], wav)
+
+def generate_local(items, writer, language_code, language_name, raw_mode):
+    engine = get_client('local')
+    voice = language_name[len(LOCAL_VOICE_PREFIX):]
+
+    def synthesize(key):
+        return engine.synthesize(voice, key)
+
+    # Everything that changes the returned audio has to be part of the cache key
+    cache_context = ('local', engine.version, voice, 'mp3', DEFAULT_MP3_BITRATE)
+    return synthesize_keys(items, writer, raw_mode, get_provider('local')['file_prefix'], limit_requests('local', synthesize, metrics=writer.metrics), cache_context,
+                           workers=LOCAL_WORKERS)
+
+# Order of registration is the order of the provider-menu.
+# Default quotas: google 1000 requests/minute, amazon 8 transactions/second for neural voices
+register_provider('google', file_prefix='GO', setup=setup_environment_google,
+                  clients={'google': create_google_client, 'google-v1beta1': create_google_beta_client},
+                  fetch_voice_catalog=fetch_google_voice_catalog, generate=generate_google, concurrency=16, requests_per_second=16)
+register_provider('amazon', file_prefix='AM', setup=setup_environment_amazon,
+                  clients={'amazon': create_amazon_client},
+                  fetch_voice_catalog=fetch_amazon_voice_catalog, generate=generate_amazon, concurrency=8, requests_per_second=8)
+# The local provider has no quota; it is only bound by the cores of this machine, known once -LW is parsed
+register_provider('local', file_prefix='LO', setup=setup_environment_local,
+                  clients={'local': create_local_client},
+                  fetch_voice_catalog=fetch_local_voice_catalog, generate=generate_local, concurrency=lambda: LOCAL_WORKERS, requests_per_second=0)
+
+
+
+
+class MappedFile(io.RawIOBase):
+    # Read-only, seekable file over a memory-map: zipfile reads straight from the page-cache without buffered copies
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self.data[self.position:self.position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.data)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+def verify_pack(pack_path):
+    # Checks every sound of a voice-pack against its manifest: size, checksum and the duration found by scanning
+    # frame- or page-headers. Returns (files, duration, problems, warnings).
+    problems = []
+    warnings = []
+    files = 0
+    duration = 0.0
+    with open(pack_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as pack_data:
+        with zipfile.ZipFile(MappedFile(pack_data)) as outer_zip:
+            manifest = read_pack_manifest(outer_zip)
+            expected = {}
+            if manifest is None:
+                # Voice-packs before 1.2.0 have no manifest; their audio can still be checked
+                warnings.append("no manifest, only the audio is checked")
+            else:
+                expected = {entry['file']: entry for entry in manifest['keys']}
+
+            with outer_zip.open(os.path.basename(pack_path)) as inner_stream, zipfile.ZipFile(inner_stream) as inner_zip:
+                # Entries are read in the order they are stored, so the inner stream is never rewound
+                for info in sorted(inner_zip.infolist(), key=lambda info: info.header_offset):
+                    if info.is_dir():
+                        continue
+                    file_name = info.filename.rpartition('/')[2]
+                    files += 1
+                    try:
+                        data = inner_zip.read(info)
+                    except (zipfile.BadZipFile, zlib.error) as e:
+                        problems.append(f"{file_name}: unreadable: {str(e)}")
+                        continue
+                    file_duration, problem = scan_audio(file_name, data)
+                    duration += file_duration
+                    if problem is not None:
+                        problems.append(f"{file_name}: {problem}")
+
+                    entry = expected.pop(file_name, None)
+                    if entry is None:
+                        if manifest is not None:
+                            problems.append(f"{file_name}: not in the manifest")
+                    elif 'sha256' in entry:
+                        if entry['size'] != len(data):
+                            problems.append(f"{file_name}: {len(data)} bytes, manifest says {entry['size']}")
+                        elif entry['sha256'] != hashlib.sha256(data).hexdigest():
+                            problems.append(f"{file_name}: checksum differs from the manifest")
+                        elif abs(entry['duration'] - file_duration) > 0.001:
+                            problems.append(f"{file_name}: {file_duration:.3f}s, manifest says {entry['duration']:.3f}s")
+                for file_name, entry in expected.items():
+                    problems.append(f"{file_name}: missing (key {entry['index']}: {entry['key']})")
+    return files, duration, problems, warnings
+
+def verify_packs(paths):
+    # Verifies voice-packs and every voice-pack below given directories; returns the count of voice-packs with problems
+    pack_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            pack_paths += sorted(glob.glob(os.path.join(path, '**', f"*.{OUTPUT_ARCHIVE_EXTENSION}"), recursive=True))
+        else:
+            pack_paths.append(path)
+    print(f"Verifying {len(pack_paths)} voice-packs:")
+
+    def verify(pack_path):
+        try:
+            return verify_pack(pack_path)
+        except Exception as e:
+            return 0, 0.0, [f"unreadable: {str(e)}"], []
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        for pack_path, (files, duration, problems, warnings) in zip(pack_paths, executor.map(verify, pack_paths)):
+            if problems:
+                failed += 1
+            print(f"{'FAILED' if problems else 'ok'} | {pack_path} | {files} files | {duration:.1f}s")
+            for problem in problems:
+                print(f"    {problem}")
+            for warning in warnings:
+                print(f"    warning: {warning}")
+    print(f"{len(pack_paths) - failed} of {len(pack_paths)} voice-packs are ok")
+    return failed
+
+def merge_packs(pack_paths, output_path = None):
+    # Combines the partial voice-packs of a sharded generation into one voice-pack. Sounds are copied as they are stored,
+    # and nothing is written unless every shard is there once and every index of the template is covered exactly once.
+    # Returns the count of problems.
+    parts = []
+    try:
+        for pack_path in pack_paths:
+            parts.append(PreviousPack(pack_path))
+        manifests = [read_pack_manifest(part.outer_zip) or {} for part in parts]
+
+        problems = [f"{part.path}: not a partial voice-pack" for part, manifest in zip(parts, manifests) if 'shard' not in manifest]
+        if not problems:
+            first = manifests[0]
+            shard_count = first['shard']['count']
+            for part, manifest in zip(parts, manifests):
+                for field in ('provider', 'voice', 'post_processing'):
+                    if manifest.get(field) != first.get(field):
+                        problems.append(f"{part.path}: {field} differs from {parts[0].path}")
+                shard = manifest['shard']
+                if (shard['count'], shard['mode'], shard['template_sha256']) != (shard_count, first['shard']['mode'], first['shard']['template_sha256']):
+                    problems.append(f"{part.path}: belongs to another sharded generation than {parts[0].path}")
+            shard_indexes = [manifest['shard']['index'] for manifest in manifests]
+            for shard_index in range(1, shard_count + 1):
+                if shard_indexes.count(shard_index) == 0:
+                    problems.append(f"shard {shard_index}/{shard_count}: missing")
+                elif shard_indexes.count(shard_index) > 1:
+                    problems.append(f"shard {shard_index}/{shard_count}: given {shard_indexes.count(shard_index)} times")
+
+            # Every partial voice-pack embeds the template; the first one found is the template of the merged voice-pack
+            keys = None
+            template_name = None
+            for part in parts:
+                part_template = next((name for name in part.outer_zip.namelist() if name.endswith(TEMPLATE_FILE_EXTENSION)), None)
+                if part_template is None:
+                    problems.append(f"{part.path}: no embedded template")
+                elif template_name is None:
+                    template_name = part_template
+                    template_data = part.outer_zip.read(template_name)
+                    with io.TextIOWrapper(io.BytesIO(template_data), encoding=TEMPLATE_FILE_ENCODING) as csvfile:
+                        keys = parse_generation_keys(csvfile)
+                    if keys_digest(keys) != first['shard']['template_sha256']:
+                        problems.append(f"{part.path}: embedded template doesn't match the manifest")
+
+            if keys is not None:
+                # Partial voice-packs name their sounds after the index in the whole template, so they only have to be collected
+                entries = {}
+                plans = []
+                for part, manifest in zip(parts, manifests):
+                    inner_files = {info.filename.rpartition('/')[2]: info for info in part.inner_zip.infolist() if not info.is_dir()}
+                    reused = {}
+                    for entry in manifest['keys']:
+                        key_index = entry['index']
+                        if key_index >= len(keys) or keys[key_index] != entry['key']:
+                            problems.append(f"{part.path}: index {key_index} isn't '{entry['key']}' in the template")
+                        elif key_index in entries:
+                            problems.append(f"index {key_index}: in {entries[key_index][0]} and {part.path}")
+                        elif entry['file'] not in inner_files:
+                            problems.append(f"{part.path}: {entry['file']} is missing")
+                        else:
+                            entries[key_index] = (part.path, entry)
+                            reused[key_index] = (entry['file'], inner_files[entry['file']])
+                    plans.append(reused)
+                missing = [str(key_index) for key_index in range(len(keys)) if key_index not in entries]
+                if missing:
+                    problems.append(f"{len(missing)} indexes missing: {', '.join(missing[:20])}{' ...' if len(missing) > 20 else ''}")
+
+        if problems:
+            print(f"Merging {len(pack_paths)} partial voice-packs FAILED:")
+            for problem in problems:
+                print(f"    {problem}")
+            return len(problems)
+
+        if output_path is None:
+            # Next to the partial voice-packs, named and versioned like a generated one
+            base = re.sub(r'-part\d+of\d+(-v\d+)?$', '', os.path.splitext(parts[0].path)[0])
+            output_path = f"{base}.{OUTPUT_ARCHIVE_EXTENSION}"
+            version_counter = 1
+            while os.path.exists(output_path):
+                version_counter += 1
+                output_path = f"{base}-v{version_counter}.{OUTPUT_ARCHIVE_EXTENSION}"
+        pack_name = os.path.splitext(os.path.basename(output_path))[0]
+        writer = PackWriter(output_path, pack_name, template_name, template_data)
+        for part, reused in zip(parts, plans):
+            writer.copy_previous(part, reused)
+        writer.close({
+            'provider': first['provider'],
+            'voice': first['voice'],
+            'post_processing': first['post_processing'],
+            'keys': (entries[key_index][1] for key_index in range(len(keys))),
+        })
+        print(f"Merged {len(parts)} partial voice-packs with {len(keys)} keys into {output_path}")
+        return 0
+    finally:
+        for part in parts:
+            part.close()
+
+def run_batch(manifest_path):
+    # Generates every voice-pack of a job-manifest without any dialog:
+    # {"concurrency": {"google": 16}, "requests_per_second": {"google": 16}, "jobs": [{"provider": "google", "template": "en-US-v3.csv", "voices": "all", "raw": false}]}
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    results = []
+    packs = {}
+    budgets = {}
+    for job in manifest['jobs']:
+        try:
+            provider = job['provider']
+            template_file = os.path.join(TEMPLATES_PATH, job['template'])
+            raw_mode = job.get('raw', False)
+            if provider not in PROVIDER_SLOTS:
+                setup_environment(provider, interactive=False)
+                budgets[provider] = manifest.get('concurrency', {}).get(provider, provider_concurrency(provider))
+                PROVIDER_SLOTS[provider] = threading.BoundedSemaphore(budgets[provider])
+                if provider in manifest.get('requests_per_second', {}):
+                    REQUESTS_PER_SECOND[provider] = manifest['requests_per_second'][provider]
+            language_code = extract_language_code(template_file)
+            if language_code is None:
+                raise ValueError(f"No language-code in template-name: {template_file}")
+            voices = job.get('voices', 'all')
+            if voices == 'all':
+                voices = list_voice_names(provider, language_code)
+            if not voices:
+                raise ValueError(f"No available voices for: {provider} - {language_code}")
+        except Exception as e:
+            # A malformed job fails on its own, the rest of the batch still runs
+            fields = job if isinstance(job, dict) else {}
+            message = f"job without \"{e.args[0]}\"" if isinstance(e, KeyError) else str(e)
+            results.append((str(fields.get('provider', '-')), str(fields.get('template', '-')), '-', f"failed: {message}", 0))
+            continue
+
+        for voice_name in voices:
+            # Packs with the same output-name share their version-numbers, so they run one after another
+            pack_key = (provider, raw_mode, language_code, voice_name)
+            packs.setdefault(provider, {}).setdefault(pack_key, []).append((template_file, language_code, voice_name, raw_mode))
+
+    def run_packs(provider, pack_jobs):
+        for template_file, language_code, voice_name, raw_mode in pack_jobs:
+            started = time.time()
             try:
-                # Set the text input to be synthesized
-                synthesis_input = texttospeech.SynthesisInput(text=key)
-
-                # Perform the text-to-speech request on the text input with the selected
-                # voice parameters and audio file type
-                response = client.synthesize_speech(
-                    input=synthesis_input, 
-                    voice=voice, 
-                    audio_config=audio_config
-                )
-
-                file_output = f"{key}{OUTPUT_FILE_EXTENSION}"
-                if not raw_mode:
-                    # BL-00001_0_48k_stereo.mp3
-                    file_output = f"GO-{str(key_index).zfill(5)}_{key_index}_mono{OUTPUT_FILE_EXTENSION}"
-
-                output_file_path = os.path.join(generation_path, file_output)
-
-                # The response's audio_content is binary.
-                with open(output_file_path, "wb") as out:
-                    # Write the response to the output file.
-                    out.write(response.audio_content)
-                success = True
+                errors = generate(provider, template_file, language_code, voice_name, raw_mode)
+                status = 'ok' if errors == 0 else f"{errors} errors"
             except Exception as e:
-                print(str(e))
-                if tries > MAX_RETRIES:
-                    errors += 1    
-    return errors
+                status = f"failed: {e}"
+            results.append((provider, os.path.basename(template_file), voice_name, status, time.time() - started))
+
+    executors = []
+    futures = []
+    for provider, provider_packs in packs.items():
+        # Enough packs run side by side to keep the provider's budget busy
+        executor = ThreadPoolExecutor(max_workers=max(1, budgets[provider] // WORKERS))
+        executors.append(executor)
+        for pack_jobs in provider_packs.values():
+            futures.append(executor.submit(run_packs, provider, pack_jobs))
+    wait(futures)
+    for executor in executors:
+        executor.shutdown()
+
+    failed = [result for result in results if result[3] != 'ok']
+    print('\r\n', '')
+    print(f"Batch finished: {len(results) - len(failed)} of {len(results)} voice-packs without errors")
+    for provider, template, voice_name, status, duration in sorted(results):
+        print(f"{provider} | {template} | {voice_name} | {round(duration)}s | {status}")
+    return len(failed)
 
 
 
@@ -499,17 +2263,96 @@ def generate_google(keys, generation_path, language_code, language_name, raw_mod
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     
-    ap.add_argument("-TP", "--templates_path", required=True, help="Absolute path to your templates")
-    ap.add_argument("-GP", "--generation_path", required=True, help="Absolute path to your generation path")
-    ap.add_argument("-GRP", "--generation_raw_path", required=True, help="Absolute path to your generation-raw path")
+    ap.add_argument("-TP", "--templates_path", required=False, help="Absolute path to your templates")
+    ap.add_argument("-GP", "--generation_path", required=False, help="Absolute path to your generation path")
+    ap.add_argument("-GRP", "--generation_raw_path", required=False, help="Absolute path to your generation-raw path")
     ap.add_argument("-MR", "--max_retries", type=int, default=DEFAULT_MAX_RETRIES, required=False, help="Maximum retry-count for an entry")
+    ap.add_argument("-RPS", "--requests_per_second", type=float, default=None, required=False, help="Maximum requests per second to a provider; '0' disables the limit (Default: google 16, amazon 8; the local provider is never limited)")
+    ap.add_argument("-W", "--workers", type=int, default=DEFAULT_WORKERS, required=False, help="Number of keys synthesized concurrently")
+    ap.add_argument("-SB", "--ssml_batch_size", type=int, default=0, required=False, help="Number of keys synthesized by one ssml-request and cut apart afterwards; '0' requests every key on its own")
+    ap.add_argument("-CP", "--cache_path", required=False, default=None, help="Absolute path to a directory that caches synthesized sounds across runs")
+    ap.add_argument("-CS", "--cache_size", type=int, default=DEFAULT_CACHE_SIZE, required=False, help="Maximum size of the synthesis cache in MB")
+    ap.add_argument("-SP", "--stream_packaging", type=int, choices=range(0, 2), default=False, required=False, help="If '1', sounds are written straight into the voice-pack instead of a directory that is zipped afterwards")
+    ap.add_argument("-CPS", "--connection_pool_size", type=int, default=DEFAULT_CONNECTION_POOL_SIZE, required=False, help="Maximum number of connections kept open to a provider")
+    ap.add_argument("-KA", "--keepalive", type=int, default=DEFAULT_KEEPALIVE, required=False, help="Seconds between keepalive-pings on idle provider-connections")
+    ap.add_argument("-VC", "--voice_catalog_path", required=False, default=None, help="Absolute path to the local voice-catalog (Default: .autodarts-caller-generator/voices.json in your home-directory)")
+    ap.add_argument("-VCT", "--voice_catalog_ttl", type=float, default=DEFAULT_VOICE_CATALOG_TTL, required=False, help="Hours until the voice-catalog of a provider is fetched again")
+    ap.add_argument("-RV", "--refresh_voices", type=int, choices=range(0, 2), default=False, required=False, help="If '1', the voice-catalog is fetched again from every provider used in this session")
+    ap.add_argument("-R", "--resume", type=int, choices=range(0, 2), default=False, required=False, help="If '1', an interrupted generation continues where it stopped instead of starting over")
+    ap.add_argument("-BM", "--batch_manifest", required=False, default=None, help="Absolute path to a job-manifest (json) that is generated without any dialog")
+    ap.add_argument("-TS", "--trim_silence", type=int, choices=range(0, 2), default=False, required=False, help="If '1', leading and trailing silence of every sound is cut off (needs ffmpeg)")
+    ap.add_argument("-LN", "--loudness", type=float, default=None, required=False, help="Integrated loudness in LUFS every sound is normalized to, e.g. -16 (needs ffmpeg)")
+    ap.add_argument("-OF", "--output_format", choices=list(OUTPUT_FORMATS), default='mp3', required=False, help="Format of the sounds; 'opus' is transcoded into ogg-files (needs ffmpeg)")
+    ap.add_argument("-OB", "--output_bitrate", type=int, default=None, required=False, help=f"Bitrate in kbit/s of post-processed sounds (Default: mp3 {DEFAULT_MP3_BITRATE}, opus {DEFAULT_OPUS_BITRATE})")
+    ap.add_argument("-PPW", "--post_processing_workers", type=int, default=POST_PROCESSING_WORKERS, required=False, help="Number of sounds post-processed concurrently (Default: number of cores)")
+    ap.add_argument("-FP", "--ffmpeg_path", required=False, default=DEFAULT_FFMPEG_PATH, help="Path to the ffmpeg-executable used for post-processing and the local provider")
+    ap.add_argument("-EP", "--espeak_path", required=False, default=DEFAULT_ESPEAK_PATH, help="Path to the espeak-ng-executable used by the local provider")
+    ap.add_argument("-LW", "--local_workers", type=int, default=LOCAL_WORKERS, required=False, help="Number of keys synthesized concurrently by the local provider (Default: number of cores)")
+    ap.add_argument("-MF", "--metrics_file", required=False, default=None, help="Path to a metrics-file written after every voice-pack; '.csv' appends one row per voice-pack, otherwise json of the whole run")
+    ap.add_argument("-V", "--verify", nargs='+', required=False, default=None, help="Verifies voice-packs (or all voice-packs of directories) against their manifest and exits")
+    ap.add_argument("-SH", "--shard", type=parse_shard, required=False, default=None, help="Generates only the K-th of N shards of the keys as a partial voice-pack, e.g. '2/8'; combine the partial voice-packs with --merge")
+    ap.add_argument("-SHM", "--shard_mode", choices=SHARD_MODES, default='index', required=False, help="How keys are split into shards: 'index' takes contiguous ranges of the template, 'hash' spreads them by key")
+    ap.add_argument("-PF", "--priority_file", required=False, default=None, help="Absolute path to a file of keys or wildcard-patterns (one per line, most important first) that are synthesized before all other keys")
+    ap.add_argument("-CK", "--checkpoint_keys", type=int, default=0, required=False, help="Publishes a usable voice-pack after the priority-keys and then every given number of keys; every checkpoint writes the whole voice-pack again. '0' publishes only after the priority-keys")
+    ap.add_argument("-M", "--merge", nargs='+', required=False, default=None, help="Merges the partial voice-packs of a sharded generation into one voice-pack and exits")
+    ap.add_argument("-MO", "--merge_output", required=False, default=None, help="Path of the merged voice-pack (Default: next to the partial voice-packs)")
     ap.add_argument("-DEB", "--debug", type=int, choices=range(0, 2), default=False, required=False, help="If '1', the application will output additional information")
     args = vars(ap.parse_args())
+    if args['verify'] is not None:
+        sys.exit(1 if verify_packs(args['verify']) > 0 else 0)
+    if args['merge'] is not None:
+        sys.exit(1 if merge_packs(args['merge'], args['merge_output']) > 0 else 0)
+    missing = [argument for argument in ('templates_path', 'generation_path', 'generation_raw_path') if args[argument] is None]
+    if missing:
+        ap.error(f"the following arguments are required: {', '.join('--' + argument for argument in missing)}")
+    if args['resume'] and args['stream_packaging']:
+        ap.error("--resume needs the sounds of an interrupted generation on disk; it can't be combined with --stream_packaging")
+    if (args['priority_file'] is not None or args['checkpoint_keys'] > 0) and args['stream_packaging']:
+        ap.error("checkpoints are built from the sounds on disk; --priority_file and --checkpoint_keys can't be combined with --stream_packaging")
+    post_processing = args['trim_silence'] or args['loudness'] is not None or args['output_format'] != 'mp3'
+    if post_processing and shutil.which(args['ffmpeg_path']) is None:
+        ap.error(f"post-processing needs ffmpeg, but '{args['ffmpeg_path']}' was not found")
 
     TEMPLATES_PATH = Path(args['templates_path'])
     GENERATION_PATH = Path(args['generation_path'])
     GENERATION_RAW_PATH = Path(args['generation_raw_path'])
     MAX_RETRIES = args['max_retries']
+    WORKERS = max(1, args['workers'])
+    if args['requests_per_second'] is not None:
+        # Providers without a quota (local) are never rate-limited
+        REQUESTS_PER_SECOND = {provider: args['requests_per_second'] for provider in PROVIDERS if PROVIDERS[provider]['requests_per_second'] > 0}
+    STREAM_PACKAGING = args['stream_packaging']
+    RESUME = args['resume']
+    if args['priority_file'] is not None:
+        PRIORITY_PATTERNS = read_priority_patterns(args['priority_file'])
+    CHECKPOINT_KEYS = max(0, args['checkpoint_keys'])
+    if args['shard'] is not None:
+        SHARD = {'index': args['shard'][0], 'count': args['shard'][1], 'mode': args['shard_mode']}
+    CONNECTION_POOL_SIZE = max(1, args['connection_pool_size'])
+    KEEPALIVE = max(1, args['keepalive'])
+    user_home = os.environ.get('USERPROFILE') or os.environ.get('HOME')
+    VOICE_CATALOG_PATH = args['voice_catalog_path']
+    if VOICE_CATALOG_PATH is None:
+        VOICE_CATALOG_PATH = os.path.join(user_home, '.autodarts-caller-generator', 'voices.json')
+    VOICE_CATALOG_TTL = args['voice_catalog_ttl']
+    if args['refresh_voices']:
+        REFRESH_VOICES = {provider: True for provider in PROVIDERS}
+    SSML_BATCH_SIZE = args['ssml_batch_size']
+    if args['cache_path'] is not None:
+        SYNTHESIS_CACHE = SynthesisCache(Path(args['cache_path']), args['cache_size'])
+    if post_processing:
+        POST_PROCESSING = {
+            'trim_silence': bool(args['trim_silence']),
+            'loudness': args['loudness'],
+            'format': args['output_format'],
+            'bitrate': args['output_bitrate'] or (DEFAULT_OPUS_BITRATE if args['output_format'] == 'opus' else DEFAULT_MP3_BITRATE),
+        }
+        POST_PROCESSING_WORKERS = max(1, args['post_processing_workers'])
+    FFMPEG_PATH = args['ffmpeg_path']
+    ESPEAK_PATH = args['espeak_path']
+    LOCAL_WORKERS = max(1, args['local_workers'])
+    OUTPUT_FILE_EXTENSION = OUTPUT_FORMATS[args['output_format']]
+    RUN_METRICS = RunMetrics(args['metrics_file'])
     DEBUG = args['debug']
 
     osType = plat
@@ -524,6 +2367,8 @@ if __name__ == "__main__":
     print('DONATION: bitcoin:bc1q8dcva098rrrq2uqhv38rj5hayzrqywhudvrmxa', '')
     print('\r\n', '')
 
+    if args['batch_manifest'] is not None:
+        sys.exit(1 if run_batch(args['batch_manifest']) > 0 else 0)
 
     # Procedure:
     # 0) Which provider would you like to use?
@@ -559,9 +2404,10 @@ if __name__ == "__main__":
             errors = 0
             while voices_left and errors == 0:
                 voice_name = voices_left.pop(0) 
-                errors = generate(provider, template_file, language_code, voice_name, raw_mode)
+                errors = generate(provider, template_file, language_code, voice_name, raw_mode, background_packaging=True)
                 if errors != 0:
                     print(f"ERROR occured for: {voice_name}")
+            wait_for_packaging()
             all_voices = False
         else:
             # 3)
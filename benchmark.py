@@ -0,0 +1,309 @@
+import os
+import sys
+import argparse
+import importlib.util
+import json
+import io
+import re
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import platform
+from xml.sax.saxutils import unescape
+
+
+# Runs the complete generate()-pipeline of autodarts-caller-generator against a simulated provider,
+# so throughput can be measured without any provider account or bill.
+# Every scenario runs in a process of its own, which makes peak-RSS comparable between scenarios.
+
+GENERATOR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autodarts-caller-generator.py')
+
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+SCENARIOS = ['fresh', 'stream', 'reuse', 'retries']
+DEFAULT_LATENCY = 0.02
+DEFAULT_JITTER = 0.25
+DEFAULT_THROTTLE_RATE = 0.05
+DEFAULT_PAYLOAD_SIZE = 8000
+DEFAULT_WORKERS = 32
+DEFAULT_REGRESSION_THRESHOLD = 10
+
+# MPEG-2 layer-3 frame, 48 kbit/s, 24 kHz (like amazon's neural voices): 144 bytes, 24 ms
+MP3_FRAME_HEADER = struct.pack('>I', (0x7ff << 21) | (2 << 19) | (1 << 17) | (1 << 16) | (6 << 12) | (1 << 10))
+MP3_FRAME_SIZE = 144
+MP3_FRAME_DURATION = 0.024
+VOICE_NAME = 'Simulated-Female'
+LANGUAGE_CODE = 'en-US'
+
+
+class SimulatedThrottlingError(Exception):
+    # Looks like botocore's ClientError to classify_error()
+    def __init__(self):
+        super().__init__("An error occurred (ThrottlingException) when calling the SynthesizeSpeech operation: Rate exceeded")
+        self.response = {'Error': {'Code': 'ThrottlingException'}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+
+class SimulatedPollyClient:
+    # Stands in for boto3's polly-client: answers synthesize_speech() after a simulated network-latency
+    # with valid mp3-frames, speech marks for ssml and throttles a share of all requests
+    def __init__(self, latency, jitter, throttle_rate, payload_size):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.frames = max(1, payload_size // MP3_FRAME_SIZE)
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def synthesize_speech(self, **request):
+        time.sleep(max(0.0, random.gauss(self.latency, self.latency * self.jitter)))
+        with self.lock:
+            self.requests += 1
+            if random.random() < self.throttle_rate:
+                self.throttled += 1
+                raise SimulatedThrottlingError()
+
+        if request.get('TextType') != 'ssml':
+            return {'AudioStream': io.BytesIO(self.audio(request['Text'], self.frames))}
+
+        keys = [unescape(key) for key in re.findall(r'<s>(.*?)</s>', request['Text'])]
+        pause_frames = 16
+        if request['OutputFormat'] == 'json':
+            lines = []
+            for key_index in range(len(keys)):
+                # Marks sit in the middle of the pause in front of their key
+                time_ms = key_index * (self.frames + pause_frames) * MP3_FRAME_DURATION * 1000
+                if key_index > 0:
+                    time_ms -= pause_frames / 2 * MP3_FRAME_DURATION * 1000
+                lines.append(json.dumps({'time': int(time_ms), 'type': 'ssml', 'value': f"k{key_index}"}))
+            return {'AudioStream': io.BytesIO('\n'.join(lines).encode('utf-8'))}
+
+        silence = self.audio('', pause_frames)
+        audio = silence.join(self.audio(key, self.frames) for key in keys)
+        return {'AudioStream': io.BytesIO(audio)}
+
+    @staticmethod
+    def audio(text, frames):
+        body = (text.encode('utf-8') or b'\x00') * MP3_FRAME_SIZE
+        return (MP3_FRAME_HEADER + body[:MP3_FRAME_SIZE - len(MP3_FRAME_HEADER)]) * frames
+
+
+def load_generator():
+    spec = importlib.util.spec_from_file_location('autodarts_caller_generator', GENERATOR_FILE)
+    generator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generator)
+    return generator
+
+def write_template(templates_path, size, version, new_keys = 0):
+    template_file = os.path.join(templates_path, f"{LANGUAGE_CODE}-v{version}.csv")
+    with open(template_file, 'w', encoding='utf-8') as file:
+        for key_index in range(size):
+            file.write(f"key number {key_index};\n")
+        for key_index in range(new_keys):
+            file.write(f"new key number {key_index};\n")
+    return template_file
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+def written_bytes():
+    # Everything the process wrote, including intermediate files (Linux only)
+    try:
+        with open('/proc/self/io', 'r') as file:
+            for line in file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+def run_scenario(scenario):
+    # Executed in a fresh process: sets the generator up like its __main__ would and runs generate() once
+    generator = load_generator()
+    work_path = scenario['work_path']
+    generator.TEMPLATES_PATH = os.path.join(work_path, 'templates')
+    generator.GENERATION_PATH = os.path.join(work_path, 'generation')
+    generator.GENERATION_RAW_PATH = os.path.join(work_path, 'generation-raw')
+    generator.MAX_RETRIES = generator.DEFAULT_MAX_RETRIES
+    generator.WORKERS = scenario['workers']
+    generator.DEBUG = False
+    generator.STREAM_PACKAGING = scenario['stream_packaging']
+    generator.SSML_BATCH_SIZE = scenario['ssml_batch_size']
+    generator.REQUESTS_PER_SECOND = {'amazon': 0}
+
+    client = SimulatedPollyClient(scenario['latency'], scenario['jitter'], scenario['throttle_rate'], scenario['payload_size'])
+    generator.CLIENTS['amazon'] = client
+
+    # Per-key latency: from the moment a worker picks the key up until its sound is written
+    latencies = []
+    latencies_lock = threading.Lock()
+    synthesize_task = generator.KeySynthesizer.synthesize_task
+    def timed_synthesize_task(self, task):
+        started = time.perf_counter()
+        results = synthesize_task(self, task)
+        elapsed = time.perf_counter() - started
+        with latencies_lock:
+            latencies.extend([elapsed] * len(results))
+        return results
+    generator.KeySynthesizer.synthesize_task = timed_synthesize_task
+
+    # The generator reports per key, which would measure the console instead of the pipeline
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        written_before = written_bytes()
+        started = time.perf_counter()
+        keys = len(generator.read_generation_keys(scenario['template_file']))
+        errors = generator.generate('amazon', scenario['template_file'], LANGUAGE_CODE, VOICE_NAME, False)
+        duration = time.perf_counter() - started
+        written_after = written_bytes()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return {
+        'errors': errors,
+        'keys': keys,
+        'synthesized': len(latencies),
+        'duration': duration,
+        'keys_per_second': keys / duration if duration > 0 else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'requests': client.requests,
+        'throttled': client.throttled,
+        'output_bytes': directory_size(generator.GENERATION_PATH),
+        'written_bytes': None if written_before is None else written_after - written_before,
+        'peak_rss': peak_rss(),
+    }
+
+def run_scenario_process(scenario):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run_scenario', json.dumps(scenario)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit-code {result.returncode}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def benchmark(args):
+    results = []
+    for size in args['sizes']:
+        for scenario_name in args['scenarios']:
+            work_path = tempfile.mkdtemp(prefix='autodarts-caller-generator-benchmark-')
+            try:
+                templates_path = os.path.join(work_path, 'templates')
+                os.makedirs(templates_path)
+                scenario = {
+                    'scenario': scenario_name,
+                    'size': size,
+                    'work_path': work_path,
+                    'workers': args['workers'],
+                    'latency': args['latency'],
+                    'jitter': args['jitter'],
+                    'throttle_rate': args['throttle_rate'] if scenario_name == 'retries' else 0.0,
+                    'payload_size': args['payload_size'],
+                    'stream_packaging': scenario_name == 'stream',
+                    'ssml_batch_size': args['ssml_batch_size'],
+                    'template_file': write_template(templates_path, size, 1),
+                }
+                if scenario_name == 'reuse':
+                    # The previous version is generated unmeasured; the measured run only adds 5% new keys
+                    run_scenario_process(scenario)
+                    scenario['template_file'] = write_template(templates_path, size, 2, new_keys=max(1, size // 20))
+
+                print(f"{scenario_name} | {size} keys ...", end=' ', flush=True)
+                metrics = run_scenario_process(scenario)
+                print(f"{metrics['keys_per_second']:.1f} keys/s, p50 {metrics['latency_p50'] * 1000:.1f} ms, p99 {metrics['latency_p99'] * 1000:.1f} ms, "
+                      f"peak-rss {(metrics['peak_rss'] or 0) / 1024 / 1024:.1f} MB, {metrics['errors']} errors")
+            except Exception as e:
+                print(f"failed: {str(e)}")
+                metrics = {'failed': str(e)}
+            finally:
+                shutil.rmtree(work_path, ignore_errors=True)
+
+            parameters = {key: value for key, value in scenario.items() if key not in ('work_path', 'template_file')}
+            results.append({**parameters, **metrics})
+    return results
+
+def compare(results, baseline_path, threshold):
+    # Compares keys/s and peak-rss per scenario and size with an earlier result-file
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = {(result['scenario'], result['size']): result for result in json.load(file)['results']}
+
+    regressions = 0
+    print('\r\n', '')
+    print(f"Compared with: {baseline_path}")
+    for result in results:
+        previous = baseline.get((result['scenario'], result['size']))
+        if previous is None or 'failed' in result or 'failed' in previous:
+            continue
+        for metric, higher_is_better in (('keys_per_second', True), ('peak_rss', False)):
+            if not previous.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric] * 100
+            regressed = -change > threshold if higher_is_better else change > threshold
+            regressions += regressed
+            print(f"{result['scenario']} | {result['size']} keys | {metric}: {change:+.1f}%{' REGRESSION' if regressed else ''}")
+    return regressions
+
+
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument("-S", "--sizes", type=int, nargs='+', default=DEFAULT_SIZES, required=False, help="Template-sizes (keys) to benchmark")
+    ap.add_argument("-SC", "--scenarios", nargs='+', choices=SCENARIOS, default=SCENARIOS, required=False, help="fresh: directory-packaging, stream: stream-packaging, reuse: extending a previous version, retries: throttled provider")
+    ap.add_argument("-W", "--workers", type=int, default=DEFAULT_WORKERS, required=False, help="Workers of the generator")
+    ap.add_argument("-L", "--latency", type=float, default=DEFAULT_LATENCY, required=False, help="Mean simulated request-latency in seconds")
+    ap.add_argument("-J", "--jitter", type=float, default=DEFAULT_JITTER, required=False, help="Standard-deviation of the latency, relative to its mean")
+    ap.add_argument("-TR", "--throttle_rate", type=float, default=DEFAULT_THROTTLE_RATE, required=False, help="Share of requests throttled in the 'retries'-scenario")
+    ap.add_argument("-PS", "--payload_size", type=int, default=DEFAULT_PAYLOAD_SIZE, required=False, help="Bytes of audio per key")
+    ap.add_argument("-SB", "--ssml_batch_size", type=int, default=0, required=False, help="Ssml-batch-size of the generator")
+    ap.add_argument("-O", "--output", required=False, default=None, help="Path of the result-file (json)")
+    ap.add_argument("-C", "--compare", required=False, default=None, help="Path of an earlier result-file to compare with")
+    ap.add_argument("-T", "--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, required=False, help="Change in percent that counts as regression")
+    ap.add_argument("--run_scenario", required=False, default=None, help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    if args['run_scenario'] is not None:
+        print(json.dumps(run_scenario(json.loads(args['run_scenario']))))
+        sys.exit(0)
+
+    generator = load_generator()
+    results = benchmark(args)
+    report = {
+        'version': generator.VERSION,
+        'python': platform.python_version(),
+        'os': f"{platform.system()} {platform.release()}",
+        'cpus': os.cpu_count(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args['output'] is not None:
+        with open(args['output'], 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=1)
+
+    regressions = 0
+    if args['compare'] is not None:
+        regressions = compare(results, args['compare'], args['threshold'])
+    sys.exit(1 if regressions > 0 else 0)